@@ -2,12 +2,68 @@
 
 import asyncio
 import json
+import logging
+import random
+import re
 import time
+from collections import OrderedDict
 import os
-from typing import Dict, List, Optional, Tuple
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
 from datetime import datetime, timedelta
 import google.generativeai as genai
 from config import SERVER_MEMBERS, MIKU_PERSONALITY, CHAT_CONFIG, DEBUG_CONFIG
+from metrics import registry
+from logs import trace_mark
+
+log = logging.getLogger("miku.ai")
+context_log = logging.getLogger("miku.ai.context")
+ratelimit_log = logging.getLogger("miku.ai.ratelimit")
+history_log = logging.getLogger("miku.history")
+
+GEMINI_REQUESTS = registry.counter("miku_gemini_requests_total", "Gemini generate requests by outcome", ["outcome"])
+GEMINI_SECONDS = registry.histogram("miku_gemini_request_seconds", "Gemini generate request latency", ["outcome"])
+AI_RATE_LIMITED = registry.counter("miku_ai_rate_limited_total", "Chat messages refused by the per-user rate limit")
+RESPONSE_CACHE = registry.counter("miku_response_cache_total", "Response cache lookups by result", ["result"])
+CHAT_MESSAGES_MERGED = registry.counter("miku_chat_messages_merged_total", "Chat messages folded into another message's request")
+GEMINI_FIRST_SENTENCE_SECONDS = registry.histogram(
+    "miku_gemini_first_sentence_seconds", "Time until a streamed reply's first complete sentence"
+)
+HISTORY_SAVE_SECONDS = registry.histogram(
+    "miku_history_save_seconds", "Time to write the conversation history file",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+# Where a streamed reply can be shown up to: after sentence-ending punctuation or a line break
+SENTENCE_END = re.compile(r'[.!?~…](?=\s)|\n')
+
+def normalize_message(text: str) -> str:
+    """Reduce a message to what matters for reuse: "Hiii Miku!!" and "hi miku" match"""
+    text = re.sub(r'(.)\1{2,}', r'\1', text.lower())
+    return " ".join(re.findall(r'[^\s.,!?~\-]+', text))
+
+def truncate_response(text: str) -> str:
+    """Keep a reply within CHAT_CONFIG["max_response_length"]"""
+    text = text.strip()
+    if len(text) > CHAT_CONFIG["max_response_length"]:
+        text = text[:CHAT_CONFIG["max_response_length"]-3] + "..."
+    return text
+
+# The part of the guidelines that never changes, appended to the personality in the prompt prefix
+RESPONSE_GUIDELINES = """
+RESPONSE GUIDELINES:
+- Respond as MikuChan with your unique personality
+- Keep responses under {max_response_length} characters
+- Be authentic to your AI nature while being cute and engaging
+- Show genuine interest and emotion
+- Reference user context naturally if you know them
+- Use occasional emojis (🎵💕✨🌸) but don't overdo it"""
+
+# Seconds a history save can wait so several cached replies are written together
+HISTORY_SAVE_DELAY = 5
+
+class ModelBusy(Exception):
+    """Raised when every model request slot stayed taken for longer than CHAT_CONFIG["queue_timeout"]"""
 
 class RateLimiter:
     """Simple rate limiter for API calls"""
@@ -37,25 +93,180 @@ class RateLimiter:
         self.user_requests[user_id].append(now)
         return False, 0
 
+class ResponseCache:
+    """LRU cache of replies to short, common messages, keeping a few variants per message.
+    
+    Until a message has CHAT_CONFIG["response_cache_variants"] replies, lookups miss so the model
+    writes another one. After that a random variant is reused until the entry expires.
+    """
+    def __init__(self):
+        self.entries: "OrderedDict[Hashable, Tuple[float, List[str]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def _live(self, key: Hashable) -> Optional[Tuple[float, List[str]]]:
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > CHAT_CONFIG["response_cache_ttl"]:
+            del self.entries[key]
+            return None
+        return entry
+    
+    def get(self, key: Hashable) -> Optional[str]:
+        entry = self._live(key)
+        if entry is None or len(entry[1]) < CHAT_CONFIG["response_cache_variants"]:
+            self.misses += 1
+            RESPONSE_CACHE.inc(result="miss")
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        RESPONSE_CACHE.inc(result="hit")
+        return random.choice(entry[1])
+    
+    def put(self, key: Hashable, reply: str):
+        entry = self._live(key)
+        if entry is None:
+            entry = self.entries[key] = (time.monotonic(), [])
+        replies = entry[1]
+        if len(replies) < CHAT_CONFIG["response_cache_variants"] and reply not in replies:
+            replies.append(reply)
+        self.entries.move_to_end(key)
+        while len(self.entries) > CHAT_CONFIG["response_cache_size"]:
+            self.entries.popitem(last=False)
+    
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class PromptPrefix:
+    """The part of every prompt that never changes, compiled once at startup.
+    
+    Holds the personality and guidelines, plus every member's profile with
+    CHAT_CONFIG["prefix_member_profiles"]. Member contexts are built once too, so building
+    a prompt only joins the per-message tail.
+    """
+    def __init__(self, personality_engine: "PersonalityEngine"):
+        self.member_contexts = {
+            member_id: personality_engine.get_member_context(member_id) for member_id in SERVER_MEMBERS
+        }
+        self.members_included = CHAT_CONFIG["prefix_member_profiles"]
+        
+        parts = [MIKU_PERSONALITY, RESPONSE_GUIDELINES.format(max_response_length=CHAT_CONFIG['max_response_length'])]
+        if self.members_included:
+            profiles = "\n".join(f"- {context}" for context in self.member_contexts.values() if context)
+            parts.append(f"\nSERVER MEMBERS YOU KNOW:\n{profiles}")
+        self.text = "\n".join(parts)
+
+class ChatBurst:
+    """Messages from one user in one channel that get answered together"""
+    def __init__(self):
+        self.entries: List[Tuple[Any, str, Callable]] = []
+        self.last_at = 0.0
+    
+    def add(self, message: Any, text: str, send: Callable):
+        self.entries.append((message, text, send))
+        self.last_at = time.monotonic()
+    
+    @property
+    def text(self) -> str:
+        return "\n".join(text for _, text, _ in self.entries)
+    
+    @property
+    def messages(self) -> List[Any]:
+        return [message for message, _, _ in self.entries]
+    
+    @property
+    def send(self) -> Callable:
+        """How the latest message wants its answer sent"""
+        return self.entries[-1][2]
+
+class ChatCoalescer:
+    """Folds a user's quick run of messages ("hiii", "miku", "u there?") into one chat request.
+    
+    A burst keeps taking messages until the user has been quiet for CHAT_CONFIG["coalesce_window"]
+    (or coalesce_max_wait has passed) and the previous request for the same user and channel has
+    finished, so messages sent while a reply is being written are answered together afterwards.
+    """
+    
+    def __init__(self):
+        self.open: Dict[Hashable, ChatBurst] = {}
+        self.locks: Dict[Hashable, asyncio.Lock] = {}
+        self.active: Dict[Hashable, int] = {}
+    
+    @asynccontextmanager
+    async def collect(self, key: Hashable, message: Any, text: str, send: Callable) -> AsyncIterator[Optional[ChatBurst]]:
+        """Add a message to its user's burst. Yields the burst to answer, or None if the message
+        joined a burst another call is answering."""
+        burst = self.open.get(key)
+        if burst is not None:
+            burst.add(message, text, send)
+            CHAT_MESSAGES_MERGED.inc()
+            yield None
+            return
+        
+        burst = self.open[key] = ChatBurst()
+        burst.add(message, text, send)
+        self.active[key] = self.active.get(key, 0) + 1
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                deadline = time.monotonic() + CHAT_CONFIG["coalesce_max_wait"]
+                while True:
+                    now = time.monotonic()
+                    quiet_in = burst.last_at + CHAT_CONFIG["coalesce_window"] - now
+                    if quiet_in <= 0 or now >= deadline:
+                        break
+                    await asyncio.sleep(min(quiet_in, deadline - now))
+                
+                # Anything arriving from here on starts the next burst
+                if self.open.get(key) is burst:
+                    del self.open[key]
+                yield burst
+        finally:
+            if self.open.get(key) is burst:
+                del self.open[key]
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+                del self.locks[key]
+
 class PersonalityEngine:
     """Handles personality context and member recognition"""
     
     def __init__(self):
         self.conversation_history: Dict[str, List[Dict]] = {}
         self.max_history = 10
+        # Kept up to date as history changes, so stats don't re-count every user's history
+        self.total_exchanges = 0
+        # Every known name, lowercased once, pointing at its member (the first member listing it wins)
+        self.member_names: Dict[str, str] = {}
+        for member_id, member_data in SERVER_MEMBERS.items():
+            for name in member_data.get("names", []):
+                self.member_names.setdefault(name.lower(), member_id)
+    
+    def load_history(self, data: Dict[str, List[Dict]]):
+        """Replace the history with previously saved history"""
+        self.conversation_history = data
+        self.total_exchanges = sum(len(history) for history in data.values())
+    
+    def merge_history(self, data: Dict[str, List[Dict]]):
+        """Add exchanges saved elsewhere, keeping each user's most recent ones in time order"""
+        for user_id, exchanges in data.items():
+            combined = {
+                (exchange["timestamp"], exchange["user_message"]): exchange
+                for exchange in self.conversation_history.get(user_id, []) + exchanges
+            }
+            ordered = sorted(combined.values(), key=lambda exchange: exchange["timestamp"])
+            self.conversation_history[user_id] = ordered[-self.max_history:]
+        self.total_exchanges = sum(len(history) for history in self.conversation_history.values())
     
     def identify_user(self, display_name: str, username: str) -> Optional[str]:
         """Identify user based on display name or username"""
-        display_lower = display_name.lower()
-        username_lower = username.lower()
-        
-        for member_id, member_data in SERVER_MEMBERS.items():
-            member_names = [name.lower() for name in member_data.get("names", [])]
-            
-            if display_lower in member_names or username_lower in member_names:
-                return member_id
-        
-        return None
+        return self.member_names.get(display_name.lower()) or self.member_names.get(username.lower())
     
     def get_member_context(self, member_id: str) -> str:
         """Get context string for known member"""
@@ -97,6 +308,7 @@ class PersonalityEngine:
         if user_id not in self.conversation_history:
             self.conversation_history[user_id] = []
         
+        self.total_exchanges += 1
         self.conversation_history[user_id].append({
             "timestamp": datetime.now().isoformat(),
             "user_message": message,
@@ -105,6 +317,7 @@ class PersonalityEngine:
         
         # Keep only recent history
         if len(self.conversation_history[user_id]) > self.max_history:
+            self.total_exchanges -= len(self.conversation_history[user_id]) - self.max_history
             self.conversation_history[user_id] = self.conversation_history[user_id][-self.max_history:]
     
     def get_conversation_context(self, user_id: str) -> str:
@@ -124,75 +337,99 @@ class PersonalityEngine:
 class MikuChatAI:
     """Main AI chat system for MikuChan"""
     
-    def __init__(self):
+    def __init__(self, history_file: str = "conversation_history.json", history_sources: Sequence[str] = ()):
         self.rate_limiter = RateLimiter()
         self.personality_engine = PersonalityEngine()
         self.genai_client = None
         self.model = None
         self.initialized = False
-        self.history_file = "conversation_history.json"
+        self.history_file = history_file
+        # Other history files merged in at startup (e.g. the other shard processes')
+        self.history_sources = [path for path in history_sources if path != history_file]
+        # The AI's own concurrency budget, so a chat burst can't crowd out anything else.
+        # Created in initialize(), inside the running loop (it binds to a loop before Python 3.10)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.response_cache = ResponseCache()
+        self._save_handle = None
+        self.prompt_prefix = PromptPrefix(self.personality_engine)
+        # Model with the prefix cached on Gemini's side, when the library and model support it
+        self.cached_model = None
+        self._prefix_expires = 0.0
+        self._prefix_retry_at = 0.0
+        self._prefix_lock: Optional[asyncio.Lock] = None  # Created in initialize(), like _slots
         self._load_history()
     
     def _load_history(self):
-        """Load conversation history from file"""
+        """Load conversation history from file, merging in any other history sources"""
         try:
             if os.path.exists(self.history_file):
                 with open(self.history_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    self.personality_engine.conversation_history = data
-                    print(f"📚 Loaded conversation history for {len(data)} users")
+                    self.personality_engine.load_history(data)
+                    history_log.info("📚 Loaded conversation history for %d users", len(data))
         except Exception as e:
-            if DEBUG_CONFIG["verbose_errors"]:
-                print(f"⚠️ Failed to load history: {e}")
+            history_log.warning("⚠️ Failed to load history: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+        
+        for path in self.history_sources:
+            try:
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    self.personality_engine.merge_history(data)
+                    history_log.info("📚 Merged conversation history for %d users from %s", len(data), path)
+            except Exception as e:
+                history_log.warning("⚠️ Failed to merge history from %s: %s", path, e, exc_info=DEBUG_CONFIG["verbose_errors"])
     
     def _save_history(self):
         """Save conversation history to file"""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
         try:
-            with open(self.history_file, 'w', encoding='utf-8') as f:
+            with HISTORY_SAVE_SECONDS.time(), open(self.history_file, 'w', encoding='utf-8') as f:
                 json.dump(self.personality_engine.conversation_history, f, indent=2, ensure_ascii=False)
         except Exception as e:
-            if DEBUG_CONFIG["verbose_errors"]:
-                print(f"⚠️ Failed to save history: {e}")
+            history_log.warning("⚠️ Failed to save history: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
         
     async def initialize(self, api_key: str) -> bool:
         """Initialize the Gemini AI client"""
         try:
-            if DEBUG_CONFIG["log_ai_requests"]:
-                print("🤖 Initializing Gemini AI client...")
+            log.info("🤖 Initializing Gemini AI client...")
             
             genai.configure(api_key=api_key)
             self.model = genai.GenerativeModel("gemini-1.5-flash")
+            if self._slots is None:
+                self._slots = asyncio.Semaphore(CHAT_CONFIG["max_in_flight"])
+            if self._prefix_lock is None:
+                self._prefix_lock = asyncio.Lock()
             self.initialized = True
             
-            if DEBUG_CONFIG["log_ai_requests"]:
-                print("✅ Gemini AI client initialized successfully!")
+            log.info("✅ Gemini AI client initialized successfully!")
             
             return True
             
         except Exception as e:
-            print(f"❌ Failed to initialize Gemini AI: {e}")
+            log.error("❌ Failed to initialize Gemini AI: %s", e)
             return False
     
     def build_prompt(self, user_message: str, user_id: str, display_name: str, username: str) -> str:
-        """Build the complete prompt with personality and context"""
-        
-        # Base personality
-        prompt_parts = [MIKU_PERSONALITY]
+        """Build the per-message part of the prompt, which follows the shared prefix (see PromptPrefix)"""
+        prompt_parts = []
         
         # Member identification and context
         member_id = self.personality_engine.identify_user(display_name, username)
         if member_id:
-            member_context = self.personality_engine.get_member_context(member_id)
-            if member_context:
-                prompt_parts.append(f"\nCURRENT USER CONTEXT:\n{member_context}")
+            if self.prompt_prefix.members_included:
+                prompt_parts.append(f"\nCURRENT USER: {member_id.title()} (see SERVER MEMBERS YOU KNOW)")
+            elif self.prompt_prefix.member_contexts.get(member_id):
+                prompt_parts.append(f"\nCURRENT USER CONTEXT:\n{self.prompt_prefix.member_contexts[member_id]}")
             
-            if DEBUG_CONFIG["log_personality_context"]:
-                print(f"🔍 Identified user as: {member_id}")
+            context_log.info("🔍 Identified user as: %s", member_id)
         else:
             prompt_parts.append(f"\nCURRENT USER: Unknown user (Display: {display_name}, Username: {username})")
             
-            if DEBUG_CONFIG["log_personality_context"]:
-                print(f"🔍 Unknown user: {display_name} ({username})")
+            context_log.info("🔍 Unknown user: %s (%s)", display_name, username)
         
         # Recent conversation context
         conversation_context = self.personality_engine.get_conversation_context(user_id)
@@ -201,60 +438,176 @@ class MikuChatAI:
         
         # Current message
         prompt_parts.append(f"\nCURRENT MESSAGE TO RESPOND TO:\n{user_message}")
+        prompt_parts.append("\nRespond now as MikuChan:")
         
-        # Response guidelines
-        prompt_parts.append(f"""
-RESPONSE GUIDELINES:
-- Respond as MikuChan with your unique personality
-- Keep responses under {CHAT_CONFIG['max_response_length']} characters
-- Be authentic to your AI nature while being cute and engaging
-- Show genuine interest and emotion
-- Reference user context naturally if you know them
-- Use occasional emojis (🎵💕✨🌸) but don't overdo it
-
-Respond now as MikuChan:""")
+        prompt = "\n".join(prompt_parts)
+        trace_mark("prompt_built")
+        return prompt
+    
+    def _save_history_soon(self):
+        """Save history shortly, so a burst of cached replies writes the file once"""
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(HISTORY_SAVE_DELAY, self._save_history)
+    
+    def response_cache_key(self, user_message: str, user_id: str, display_name: str, username: str) -> Optional[Tuple]:
+        """Key for reusing replies: the normalized message, who's asking and a rough view of the
+        conversation so far. None if the message is too long to be worth caching."""
+        normalized = normalize_message(user_message)
+        if not normalized or len(normalized) > CHAT_CONFIG["response_cache_max_length"]:
+            return None
+        # Known members share replies across their accounts; anyone else only reuses their own
+        asker = self.personality_engine.identify_user(display_name, username) or f"user:{user_id}"
+        recent = self.personality_engine.conversation_history.get(user_id, [])[-3:]
+        last_topic = normalize_message(recent[-1]["user_message"])[:20] if recent else ""
+        return (normalized, asker, len(recent), last_topic)
+    
+    async def _prefix_cached_model(self):
+        """The model with the prompt prefix cached on Gemini's side, or None to send the prefix inline.
+        
+        Needs a google-generativeai with context caching (genai.caching); with an older library,
+        or if Gemini refuses (e.g. the prefix is under the minimum cacheable size), the prefix is
+        sent with every request and creating the cache is retried later.
+        """
+        if not CHAT_CONFIG["provider_prefix_cache"] or not hasattr(genai, "caching") or self._prefix_lock is None:
+            return None
+        async with self._prefix_lock:
+            now = time.monotonic()
+            if self.cached_model is not None and now < self._prefix_expires - 60:
+                return self.cached_model
+            if now < self._prefix_retry_at:
+                return None
+            
+            ttl = CHAT_CONFIG["prefix_cache_ttl"]
+            try:
+                cache = await asyncio.get_running_loop().run_in_executor(None, lambda: genai.caching.CachedContent.create(
+                    model=CHAT_CONFIG["prefix_cache_model"],
+                    system_instruction=self.prompt_prefix.text,
+                    ttl=timedelta(seconds=ttl),
+                ))
+                self.cached_model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+                self._prefix_expires = now + ttl
+                log.info("📌 Cached the %d-byte prompt prefix with Gemini", len(self.prompt_prefix.text.encode('utf-8')))
+                return self.cached_model
+            except Exception as e:
+                self.cached_model = None
+                self._prefix_retry_at = now + 600
+                log.warning("⚠️ Couldn't cache the prompt prefix with Gemini, sending it inline: %s", e)
+                return None
+    
+    async def _request(self, prompt: str, on_text: Callable[[str], Awaitable] = None) -> str:
+        """Ask the model for a reply, streaming it through on_text (with the text so far) if given.
+        
+        prompt is the per-message tail; the prefix is either already cached with Gemini or sent in front of it.
+        """
+        model = await self._prefix_cached_model()
+        if model is None:
+            model, prompt = self.model, f"{self.prompt_prefix.text}\n{prompt}"
+        
+        generation_config = genai.types.GenerationConfig(
+            temperature=CHAT_CONFIG["temperature"],
+            top_p=CHAT_CONFIG["top_p"],
+            max_output_tokens=CHAT_CONFIG["max_tokens"],
+        )
+        if on_text is None:
+            response = await model.generate_content_async(prompt, generation_config=generation_config)
+            return response.text if response else ""
+        
+        response = await model.generate_content_async(prompt, generation_config=generation_config, stream=True)
+        text = ""
+        async for chunk in response:
+            text += chunk.text
+            await on_text(text)
+        return text
+    
+    async def _call_model(self, prompt: str, on_text: Callable[[str], Awaitable] = None) -> str:
+        """Make one native async model call inside the in-flight budget and the request timeout.
         
-        return "\n".join(prompt_parts)
+        Cancelling the caller (e.g. the asking message was deleted) abandons the request.
+        """
+        try:
+            await asyncio.wait_for(self._slots.acquire(), CHAT_CONFIG["queue_timeout"])
+        except asyncio.TimeoutError:
+            raise ModelBusy(f"all {CHAT_CONFIG['max_in_flight']} model slots are busy") from None
+        
+        self.in_flight += 1
+        try:
+            return await asyncio.wait_for(self._request(prompt, on_text), CHAT_CONFIG["request_timeout"])
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
     
-    async def generate_response(self, user_message: str, user_id: str, display_name: str, username: str) -> Tuple[str, bool]:
-        """Generate AI response. Returns (response, success)"""
+    async def generate_response(self, user_message: str, user_id: str, display_name: str, username: str,
+                                on_partial: Callable[[str], Awaitable] = None) -> Tuple[str, bool]:
+        """Generate AI response. Returns (response, success)
+        
+        With on_partial the reply is streamed: on_partial gets the text up to the last complete
+        sentence each time another one arrives. History is only written once the reply is complete.
+        """
         
         if not self.initialized:
             return "Sorry, my AI brain isn't working right now 😢", False
         
+        # Common short messages are answered from cache, with no model call or rate limit quota
+        cache_key = self.response_cache_key(user_message, user_id, display_name, username)
+        cached = self.response_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            self.personality_engine.add_to_history(user_id, user_message, cached)
+            self._save_history_soon()
+            trace_mark("cache_hit")
+            return cached, True
+        
         # Check rate limiting
         is_limited, reset_time = self.rate_limiter.is_rate_limited(user_id)
         if is_limited:
-            if DEBUG_CONFIG["log_rate_limits"]:
-                print(f"⏰ Rate limited user {display_name} for {reset_time}s")
+            AI_RATE_LIMITED.inc()
+            ratelimit_log.info("⏰ Rate limited user %s for %ds", display_name, reset_time)
             return f"Whoa, slow down there! Give me {reset_time} seconds to catch up~ 💫", False
         
         try:
-            if DEBUG_CONFIG["log_ai_requests"]:
-                print(f"🤖 Generating response for {display_name}: {user_message[:50]}...")
+            log.info("🤖 Generating response for %s: %.50s...", display_name, user_message)
             
             # Build the prompt
             prompt = self.build_prompt(user_message, user_id, display_name, username)
             
             # Generate response
-            response = await asyncio.get_event_loop().run_in_executor(
-                None, 
-                lambda: self.model.generate_content(
-                    prompt,
-                    generation_config=genai.types.GenerationConfig(
-                        temperature=CHAT_CONFIG["temperature"],
-                        top_p=CHAT_CONFIG["top_p"],
-                        max_output_tokens=CHAT_CONFIG["max_tokens"],
-                    )
-                )
-            )
+            started = time.perf_counter()
+            shown = 0
+            
+            async def stream_sentences(text):
+                nonlocal shown
+                ends = [match.end() for match in SENTENCE_END.finditer(text, shown)]
+                if not ends:
+                    return
+                if not shown:
+                    GEMINI_FIRST_SENTENCE_SECONDS.observe(time.perf_counter() - started)
+                    trace_mark("first_sentence")
+                shown = ends[-1]
+                await on_partial(truncate_response(text[:shown]))
+            
+            on_text = stream_sentences if on_partial is not None else None
             
-            if response and response.text:
-                response_text = response.text.strip()
+            try:
+                response = await self._call_model(prompt, on_text)
+            except BaseException as e:
+                outcome = {
+                    ModelBusy: "busy",
+                    asyncio.TimeoutError: "timeout",
+                    asyncio.CancelledError: "cancelled",
+                }.get(type(e), "error")
+                GEMINI_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+                GEMINI_REQUESTS.inc(outcome=outcome)
+                raise
+            GEMINI_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+            trace_mark("model_responded")
+            
+            if response and response.strip():
+                GEMINI_REQUESTS.inc(outcome="ok")
                 
                 # Ensure response isn't too long
-                if len(response_text) > CHAT_CONFIG["max_response_length"]:
-                    response_text = response_text[:CHAT_CONFIG["max_response_length"]-3] + "..."
+                response_text = truncate_response(response)
+                
+                if cache_key:
+                    self.response_cache.put(cache_key, response_text)
                 
                 # Add to conversation history
                 self.personality_engine.add_to_history(user_id, user_message, response_text)
@@ -262,19 +615,26 @@ Respond now as MikuChan:""")
                 # Save history to file
                 self._save_history()
                 
-                if DEBUG_CONFIG["log_ai_requests"]:
-                    print(f"✅ Generated response ({len(response_text)} chars)")
+                log.info("✅ Generated response (%d chars)", len(response_text))
                 
                 return response_text, True
             else:
+                GEMINI_REQUESTS.inc(outcome="empty")
                 return "Hmm, I'm having trouble thinking right now... 🤔", False
+        
+        except ModelBusy:
+            log.warning("⏳ Model busy, turned away %s", display_name)
+            return "So many people are talking to me at once! Try again in a moment~ 💫", False
+        
+        except asyncio.TimeoutError:
+            log.warning("⏳ Model request for %s timed out after %ss", display_name, CHAT_CONFIG["request_timeout"])
+            return "I got lost in thought and lost track of time... ask me again? 🌸", False
                 
         except Exception as e:
-            error_msg = str(e)
             if DEBUG_CONFIG["verbose_errors"]:
-                print(f"❌ AI generation error: {error_msg}")
+                log.error("❌ AI generation error: %s", e)
             else:
-                print(f"❌ AI generation failed")
+                log.error("❌ AI generation failed")
             
             # Friendly error responses
             error_responses = [
@@ -287,14 +647,29 @@ Respond now as MikuChan:""")
             import random
             return random.choice(error_responses), False
     
+    async def check_backend(self) -> str:
+        """Check that the Gemini API answers, with a model lookup that uses no generation quota"""
+        if not self.initialized:
+            raise RuntimeError("AI chat is not initialized")
+        model = await asyncio.get_event_loop().run_in_executor(None, genai.get_model, "models/gemini-1.5-flash")
+        return f"{model.display_name} reachable"
+    
     def get_stats(self) -> Dict:
         """Get chat system statistics"""
-        total_conversations = sum(len(history) for history in self.personality_engine.conversation_history.values())
-        active_users = len(self.personality_engine.conversation_history)
+        requests = GEMINI_REQUESTS.total()
+        errors = sum(GEMINI_REQUESTS.get(outcome=outcome) for outcome in ("error", "timeout", "busy"))
         
         return {
             "initialized": self.initialized,
-            "total_conversations": total_conversations,
-            "active_users": active_users,
+            "total_conversations": self.personality_engine.total_exchanges,
+            "active_users": len(self.personality_engine.conversation_history),
             "known_members": len(SERVER_MEMBERS),
+            "in_flight": self.in_flight,
+            "requests": int(requests),
+            "errors": int(errors),
+            "error_rate": errors / requests if requests else 0.0,
+            "latency": GEMINI_SECONDS.summary(),
+            "rate_limited": int(AI_RATE_LIMITED.total()),
+            "response_cache": self.response_cache.get_stats(),
+            "history_save": HISTORY_SAVE_SECONDS.summary(),
         }
\ No newline at end of file
@@ -0,0 +1,116 @@
+# bench_opus_frames.py - CPU cost per stream: FFmpegPCMAudio vs pre-encoded Opus frames
+#
+# Usage: python benchmarks/bench_opus_frames.py [audio file] [--seconds 60] [--runs 3]
+#
+# Without an audio file a test tone is generated with FFmpeg. Each path is read as fast as
+# possible and the CPU time of this process plus its FFmpeg children is divided by the
+# amount of audio produced, so the numbers compare directly to real-time playback.
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+from opus_frames import OpusFrameSource, encode_frames, FRAME_SECONDS
+
+def cpu_seconds():
+    """CPU used so far by this process and its reaped children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def make_tone(path, seconds):
+    """Generate a stereo test tone as Opus-in-WebM, like a typical YouTube download"""
+    subprocess.run([
+        'ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-f', 'lavfi',
+        '-i', f'sine=frequency=440:duration={seconds}', '-ac', '2', '-c:a', 'libopus', path,
+    ], check=True)
+
+def run_pcm(path, encoder):
+    """The current path: FFmpeg decodes to PCM, volume is scaled in Python, discord.py encodes Opus"""
+    source = discord.PCMVolumeTransformer(
+        discord.FFmpegPCMAudio(path, before_options='-nostdin', options='-vn'), volume=0.5
+    )
+    frames = 0
+    try:
+        while True:
+            pcm = source.read()
+            if not pcm:
+                break
+            if encoder is not None:
+                encoder.encode(pcm, encoder.SAMPLES_PER_FRAME)
+            frames += 1
+    finally:
+        source.cleanup()
+    return frames
+
+def run_frames(path):
+    """The frame store path: packets come straight out of a memory map"""
+    source = OpusFrameSource(path)
+    frames = 0
+    try:
+        while source.read():
+            frames += 1
+    finally:
+        source.cleanup()
+    return frames
+
+def measure(name, fn, runs):
+    results = []
+    for _ in range(runs):
+        cpu_before, wall_before = cpu_seconds(), time.perf_counter()
+        frames = fn()
+        cpu = cpu_seconds() - cpu_before
+        wall = time.perf_counter() - wall_before
+        results.append((frames, cpu, wall))
+
+    frames = results[0][0]
+    audio = frames * FRAME_SECONDS
+    cpu = min(result[1] for result in results)
+    wall = min(result[2] for result in results)
+    print(
+        f"{name:<28} {frames:>7} frames  {cpu * 1000:>9.1f} ms CPU  "
+        f"{cpu / audio * 1000:>7.3f} ms CPU per audio second  "
+        f"~{audio / cpu if cpu else float('inf'):>8.0f} streams/core  ({wall * 1000:.0f} ms wall)"
+    )
+    return cpu / audio if audio else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU per stream: FFmpegPCMAudio vs pre-encoded Opus frames")
+    parser.add_argument('audio', nargs='?', help="Audio file to benchmark (default: generated tone)")
+    parser.add_argument('--seconds', type=int, default=60, help="Length of the generated tone")
+    parser.add_argument('--runs', type=int, default=3, help="Runs per path (best is reported)")
+    args = parser.parse_args()
+
+    try:
+        discord.opus._load_default()
+        encoder = discord.opus.Encoder()
+    except Exception as e:
+        print(f"⚠️ libopus not available ({e}), PCM path will skip Opus encoding and look cheaper than it is")
+        encoder = None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        audio = args.audio
+        if audio is None:
+            audio = os.path.join(tmp, 'tone.webm')
+            make_tone(audio, args.seconds)
+
+        frame_file = os.path.join(tmp, 'tone.mkop')
+        start = time.perf_counter()
+        encode_frames(audio, frame_file, volume=0.5)
+        print(f"Built frame file in {(time.perf_counter() - start) * 1000:.0f} ms "
+              f"({os.path.getsize(frame_file) / 1024:.0f} KiB)\n")
+
+        pcm = measure("FFmpegPCMAudio + encode", lambda: run_pcm(audio, encoder), args.runs)
+        frames = measure("Opus frame store", lambda: run_frames(frame_file), args.runs)
+        if frames:
+            print(f"\nFrame store uses {pcm / frames:.0f}x less CPU per stream")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+# bench_playback.py - Time to first audio, inter-track gaps and CPU per stream for the music pipeline
+#
+# Usage: python benchmarks/bench_playback.py [audio file] [--guilds 1 10 100] [--tracks 3]
+#                                            [--seconds 10] [--mode stream|download]
+#
+# Runs fully offline. yt-dlp is replaced by a stand-in that serves the audio file from a local
+# HTTP server (with a simulated extraction delay), and each server gets a fake voice client that
+# consumes frames in real time on its own thread, the way discord.py's AudioPlayer does.
+#
+# For every guild count it measures:
+#   - YTDLSource.from_url: call to first audio frame
+#   - !play: command to first audio frame heard by the voice client
+#   - play_next: gap between one song's last frame and the next song's first frame
+#   - frames delivered late (more than one frame behind the real-time schedule)
+#   - CPU of this process plus its FFmpeg children per second of audio played, including the
+#     background downloads and loudness analysis the bot would do anyway
+
+import argparse
+import asyncio
+import contextlib
+import http.server
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+from config import MUSIC_CONFIG, LOG_CONFIG
+from bench_opus_frames import cpu_seconds, make_tone
+
+FRAME_SECONDS = 0.02
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class MediaServer:
+    """Serves the benchmark audio over HTTP, so streamed songs go through FFmpeg's network input"""
+
+    def __init__(self, directory):
+        handler = lambda *args, **kwargs: QuietHandler(*args, directory=directory, **kwargs)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, name):
+        # Stream URLs carry an expiry like YouTube's, so the bot treats them as fresh
+        return f"http://127.0.0.1:{self.port}/{name}?expire={int(time.time()) + 6 * 3600}"
+
+    def close(self):
+        self.server.shutdown()
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class StandInYDL:
+    """Answers the yt-dlp calls the bot makes, from a single local audio file"""
+
+    media_file = None
+    media_server = None
+    duration = 0
+    extract_delay = 0.0
+    download_delay = 0.0
+
+    def __init__(self, options):
+        self.options = options
+
+    def add_progress_hook(self, hook):
+        pass
+
+    def extract_info(self, query, download=False, process=True):
+        time.sleep(self.extract_delay)
+        video_id = query.rsplit(':', 1)[-1]
+        return {
+            'id': video_id,
+            'title': f"Benchmark song {video_id}",
+            'duration': self.duration,
+            'extractor_key': 'Bench',
+            'webpage_url': f"bench:{video_id}",
+            'url': self.media_server.url(os.path.basename(self.media_file)),
+            'ext': 'webm',
+            'acodec': 'opus',
+            'abr': 128,
+        }
+
+    def prepare_filename(self, data):
+        return os.path.join(MUSIC_CONFIG["cache_dir"], f"{data['extractor_key']}-{data['id']}.{data['ext']}")
+
+    def process_info(self, data):
+        time.sleep(self.download_delay)
+        shutil.copyfile(self.media_file, self.prepare_filename(data))
+
+class GuildStats:
+    """What one server's voice client heard"""
+
+    def __init__(self, expected_tracks, loop):
+        self.expected_tracks = expected_tracks
+        self.loop = loop
+        self.done = asyncio.Event()
+        self.requested_at = None
+        self.ttfa = []
+        self.gaps = []
+        self.frames = 0
+        self.late_frames = 0
+        self.tracks_ended = 0
+        self.last_end = None
+
+    def first_frame(self, now):
+        if self.requested_at is not None:
+            self.ttfa.append(now - self.requested_at)
+            self.requested_at = None
+        elif self.last_end is not None:
+            self.gaps.append(now - self.last_end)
+
+    def track_ended(self, now):
+        self.last_end = now
+        self.tracks_ended += 1
+        if self.tracks_ended >= self.expected_tracks:
+            self.loop.call_soon_threadsafe(self.done.set)
+
+class FakeVoiceClient:
+    """Stands in for discord.VoiceClient, playing each source on a thread at real-time pace"""
+
+    def __init__(self, stats, encoder):
+        self.stats = stats
+        self.encoder = encoder
+        self._source = None
+        self._playing = False
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        if not self._playing:
+            raise ValueError('Not playing anything.')
+        self._source = value
+
+    def is_playing(self):
+        return self._playing and self._resumed.is_set() and not self._end.is_set()
+
+    def is_paused(self):
+        return self._playing and not self._resumed.is_set() and not self._end.is_set()
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        self._source = source
+        self._playing = True
+        self._end = threading.Event()
+        self._resumed.set()
+        threading.Thread(target=self._run, args=(self._end, after), daemon=True).start()
+
+    def _run(self, end, after):
+        error = None
+        first = True
+        next_time = None
+        source = self._source
+        try:
+            while not end.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+                    next_time = None
+                    continue
+
+                source = self._source
+                data = source.read()
+                now = time.perf_counter()
+                if not data:
+                    break
+                if not source.is_opus() and self.encoder is not None:
+                    self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+
+                if first:
+                    self.stats.first_frame(now)
+                    first = False
+                if next_time is None:
+                    next_time = now
+                elif now > next_time + FRAME_SECONDS:
+                    self.stats.late_frames += 1
+                self.stats.frames += 1
+
+                next_time += FRAME_SECONDS
+                time.sleep(max(0.0, next_time - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            self.stats.track_ended(time.perf_counter())
+            end.set()
+            if after is not None:
+                after(error)
+            source.cleanup()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+        self._playing = False
+
+class FakeContext:
+    """The parts of commands.Context the music commands use"""
+
+    def __init__(self, guild_id, voice_client):
+        self.guild = SimpleNamespace(id=guild_id, shard_id=0)
+        self.voice_client = voice_client
+        self.author = SimpleNamespace(voice=None)
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+    def typing(self):
+        return contextlib.nullcontext()
+
+async def bench_from_url(bot_module, guild_ids, run_id, stream):
+    """Time YTDLSource.from_url from the call to the first audio frame it produces"""
+    loop = asyncio.get_running_loop()
+
+    async def one(guild_id):
+        start = time.perf_counter()
+        player = await bot_module.YTDLSource.from_url(
+            f"bench:{run_id}-u{guild_id}", guild_id=guild_id, loop=loop, stream=stream, volume=0.5
+        )
+        try:
+            await loop.run_in_executor(None, player.read)
+            return time.perf_counter() - start
+        finally:
+            player.stopped = True
+            player.track.cancel_download()
+            player.cleanup()
+
+    return await asyncio.gather(*(one(guild_id) for guild_id in guild_ids))
+
+async def bench_play(bot_module, guild_ids, run_id, tracks, encoder, timeout):
+    """Drive !play for every server, queueing the rest of the songs behind the first"""
+    loop = asyncio.get_running_loop()
+    all_stats = []
+
+    async def one(guild_id):
+        stats = GuildStats(tracks, loop)
+        all_stats.append(stats)
+        ctx = FakeContext(guild_id, FakeVoiceClient(stats, encoder))
+
+        stats.requested_at = time.perf_counter()
+        await bot_module.play.callback(ctx, query=f"bench:{run_id}-g{guild_id}-t0")
+        for n in range(1, tracks):
+            await bot_module.play.callback(ctx, query=f"bench:{run_id}-g{guild_id}-t{n}")
+        await asyncio.wait_for(stats.done.wait(), timeout)
+
+    await asyncio.gather(*(one(guild_id) for guild_id in guild_ids))
+    return all_stats
+
+def report(name, values):
+    print(
+        f"  {name:<32} p50 {percentile(values, 0.50) * 1000:>7.0f} ms   "
+        f"p95 {percentile(values, 0.95) * 1000:>7.0f} ms   p99 {percentile(values, 0.99) * 1000:>7.0f} ms"
+    )
+
+async def run_scale(bot_module, guilds, args, encoder, quiet):
+    loop = asyncio.get_running_loop()
+    bot_module.bot.loop = loop
+    run_id = f"r{guilds}"
+    guild_ids = [guilds * 1000 + i for i in range(guilds)]
+    timeout = args.tracks * args.seconds * 3 + 120
+
+    cpu_before = cpu_seconds()
+    with quiet():
+        from_url = await bench_from_url(bot_module, guild_ids, run_id, args.mode == 'stream')
+        stats = await bench_play(bot_module, guild_ids, run_id, args.tracks, encoder, timeout)
+        # Let background downloads and loudness analysis finish so their CPU is counted
+        while any(not task.done() for task in asyncio.all_tasks() if task is not asyncio.current_task()):
+            await asyncio.sleep(0.1)
+        await loop.run_in_executor(bot_module.audio_executor, lambda: None)
+    cpu = cpu_seconds() - cpu_before
+
+    for states in bot_module.shard_states.values():
+        for state in states.values():
+            state.clear()
+    bot_module.shard_states.clear()
+
+    ttfa = [value for guild in stats for value in guild.ttfa]
+    gaps = [value for guild in stats for value in guild.gaps]
+    frames = sum(guild.frames for guild in stats)
+    late = sum(guild.late_frames for guild in stats)
+    audio = frames * FRAME_SECONDS
+
+    print(f"\n== {guilds} guild{'s' if guilds != 1 else ''} ({args.mode} mode, {args.tracks} x {args.seconds}s songs each) ==")
+    report("YTDLSource.from_url first audio", from_url)
+    report("!play first audio", ttfa)
+    report("play_next inter-track gap", gaps)
+    print(f"  {'late frames':<32} {late} of {frames} ({late / frames * 100 if frames else 0:.2f}%)")
+    print(f"  {'FFmpeg starts refused':<32} {bot_module.ffmpeg_supervisor.get_stats()['rejected']}")
+    if audio:
+        print(f"  {'CPU per audio second':<32} {cpu / audio * 1000:.2f} ms  "
+              f"(~{cpu / audio * 100:.2f}% of a core per stream)")
+
+async def run(bot_module, args, encoder, quiet):
+    for guilds in args.guilds:
+        await run_scale(bot_module, guilds, args, encoder, quiet)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first audio, gaps and CPU per stream, offline")
+    parser.add_argument('audio', nargs='?', help="Audio file to play (default: generated tone)")
+    parser.add_argument('--guilds', type=int, nargs='+', default=[1, 10, 100], help="Simulated server counts")
+    parser.add_argument('--tracks', type=int, default=3, help="Songs played back to back per server")
+    parser.add_argument('--seconds', type=int, default=10, help="Length of the generated tone")
+    parser.add_argument('--mode', choices=('stream', 'download'), default='stream', help="Playback mode to test")
+    parser.add_argument('--extract-delay', type=float, default=0.3, help="Simulated extraction time (seconds)")
+    parser.add_argument('--download-delay', type=float, default=0.5, help="Simulated download time (seconds)")
+    parser.add_argument('--verbose', action='store_true', help="Show the bot's own log output")
+    args = parser.parse_args()
+
+    try:
+        discord.opus._load_default()
+        encoder = discord.opus.Encoder()
+    except Exception as e:
+        print(f"⚠️ libopus not available ({e}), PCM players will skip Opus encoding and look cheaper than they are")
+        encoder = None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        media_dir = os.path.join(tmp, 'media')
+        os.makedirs(media_dir)
+        media_file = os.path.join(media_dir, 'song.webm')
+        if args.audio:
+            shutil.copyfile(args.audio, media_file)
+        else:
+            make_tone(media_file, args.seconds)
+
+        # The bot must not touch the real cache or need real credentials
+        MUSIC_CONFIG["cache_dir"] = os.path.join(tmp, 'cache')
+        MUSIC_CONFIG["playback_mode"] = args.mode
+        # Every server plays at once, and each may also be downloading and analysing its song:
+        # size the supervisor's global cap for the largest run (the per-server cap stays as configured)
+        MUSIC_CONFIG["ffmpeg_max_processes"] = max(
+            MUSIC_CONFIG["ffmpeg_max_processes"], MUSIC_CONFIG["ffmpeg_max_per_guild"] * max(args.guilds)
+        )
+        os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+        os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+        if not args.verbose:
+            LOG_CONFIG["level"] = "WARNING"
+        bot_module = importlib.import_module('bot')
+
+        server = MediaServer(media_dir)
+        StandInYDL.media_file = media_file
+        StandInYDL.media_server = server
+        StandInYDL.duration = args.seconds
+        StandInYDL.extract_delay = args.extract_delay
+        StandInYDL.download_delay = args.download_delay
+        bot_module.extraction_pool = bot_module.ExtractionPool(
+            bot_module.ytdl_format_options, MUSIC_CONFIG["extraction_workers"], ydl_class=StandInYDL
+        )
+
+        devnull = open(os.devnull, 'w')
+
+        def quiet():
+            if args.verbose:
+                return contextlib.nullcontext()
+            return contextlib.redirect_stdout(devnull)
+
+        try:
+            asyncio.run(run(bot_module, args, encoder, quiet))
+        finally:
+            server.close()
+            devnull.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# bench_prompt.py - Prompt bytes per chat request, with the static prefix sent inline vs cached
+#
+# Usage: python benchmarks/bench_prompt.py [--requests 200] [--members]
+#
+# Runs fully offline. google.generativeai is replaced by a stand-in that records what each
+# request sends, and can register a cached context the way Gemini's context caching does.
+# For both modes it reports:
+#   - bytes sent per request, and how many of them are the static prompt prefix
+#   - bytes registered once as a cached context
+#   - time to build the per-message prompt
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import CHAT_CONFIG, SERVER_MEMBERS
+import ai_chat
+
+MESSAGES = [
+    "hiii miku", "what's your favourite song?", "i had such a long day at work today",
+    "can you recommend an anime", "good night miku", "do you remember what i said earlier?",
+]
+
+class StandInResponse:
+    def __init__(self, text):
+        self.text = text
+
+class StandInModel:
+    """Counts the bytes of every request, and which of them repeat the prompt prefix"""
+
+    def __init__(self, stats, cached_prefix=None):
+        self.stats = stats
+        self.cached_prefix = cached_prefix
+
+    @classmethod
+    def from_cached_content(cls, cached_content):
+        return cls(cached_content.stats, cached_prefix=cached_content.system_instruction)
+
+    async def generate_content_async(self, contents, generation_config=None, stream=False):
+        sent = contents.encode('utf-8')
+        prefix = self.stats.prefix.encode('utf-8')
+        self.stats.requests += 1
+        self.stats.bytes_sent += len(sent)
+        if sent.startswith(prefix):
+            self.stats.prefix_bytes += len(prefix)
+        return StandInResponse("Hehe, hi there~ 🎵")
+
+def stand_in_genai(stats, caching):
+    """A google.generativeai look-alike; with caching it also offers genai.caching"""
+    def create(model, system_instruction, ttl):
+        stats.cached_bytes += len(system_instruction.encode('utf-8'))
+        return SimpleNamespace(stats=stats, system_instruction=system_instruction)
+
+    module = SimpleNamespace(
+        configure=lambda api_key: None,
+        GenerativeModel=lambda name: StandInModel(stats),
+        types=SimpleNamespace(GenerationConfig=lambda **kwargs: kwargs),
+    )
+    module.GenerativeModel.from_cached_content = StandInModel.from_cached_content
+    if caching:
+        module.caching = SimpleNamespace(CachedContent=SimpleNamespace(create=create))
+    return module
+
+async def bench(requests, caching):
+    stats = SimpleNamespace(requests=0, bytes_sent=0, prefix_bytes=0, cached_bytes=0, prefix="")
+    ai_chat.genai = stand_in_genai(stats, caching)
+
+    miku = ai_chat.MikuChatAI(history_file=os.path.join(os.path.dirname(__file__), "no-such-history.json"))
+    stats.prefix = miku.prompt_prefix.text
+    await miku.initialize("benchmark")
+
+    members = [data["names"][0] for data in SERVER_MEMBERS.values() if data.get("names")] + ["stranger"]
+    build_time = 0.0
+    for i in range(requests):
+        name = members[i % len(members)]
+        message = f"{MESSAGES[i % len(MESSAGES)]} ({i})"
+
+        start = time.perf_counter()
+        miku.build_prompt(message, str(i % 7), name, name)
+        build_time += time.perf_counter() - start
+
+        await miku.generate_response(message, str(i % 7), name, name)
+
+    return stats, build_time / requests
+
+def report(label, stats, build_time):
+    per_request = stats.bytes_sent / stats.requests
+    prefix = stats.prefix_bytes / stats.requests
+    print(f"\n== {label} ==")
+    print(f"  {'requests':<28} {stats.requests}")
+    print(f"  {'bytes sent per request':<28} {per_request:.0f}")
+    print(f"  {'prefix bytes per request':<28} {prefix:.0f} ({prefix / per_request * 100 if per_request else 0:.0f}%)")
+    print(f"  {'cached once':<28} {stats.cached_bytes} bytes")
+    print(f"  {'build_prompt':<28} {build_time * 1e6:.1f} µs")
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt bytes per chat request, prefix inline vs cached")
+    parser.add_argument('--requests', type=int, default=200, help="Chat requests per mode")
+    parser.add_argument('--members', action='store_true', help="Put every member profile in the prefix")
+    args = parser.parse_args()
+
+    CHAT_CONFIG["prefix_member_profiles"] = args.members
+    # Measure the model path only: no per-user limit, no response cache, no history file writes
+    CHAT_CONFIG["rate_limit_per_user"] = args.requests + 1
+    CHAT_CONFIG["response_cache_max_length"] = 0
+    ai_chat.MikuChatAI._save_history = lambda self: None
+
+    for label, caching in (("prefix sent inline", False), ("prefix cached with provider", True)):
+        stats, build_time = asyncio.run(bench(args.requests, caching))
+        report(label, stats, build_time)
+
+if __name__ == '__main__':
+    main()
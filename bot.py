@@ -3,14 +3,32 @@ from discord.ext import commands
 import asyncio
 import yt_dlp
 import os
+import glob
+import logging
+import math
 import subprocess
 import time
-import glob
+import urllib.parse
+import random
+from collections import deque
+from datetime import timedelta
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 from dotenv import load_dotenv
 
 # Import AI chat system
-from ai_chat import MikuChatAI
-from config import DEBUG_CONFIG
+from ai_chat import MikuChatAI, ChatCoalescer
+from music_cache import DownloadCache, MetadataCache, stream_url_expiry, measure_loudness
+from extraction import ExtractionPool, current_job_cancelled, EXTRACTION_SECONDS
+from presence import PresenceManager
+from opus_frames import OpusFrameSource, encode_frames, FRAME_SECONDS
+from ffmpeg_supervisor import FFmpegSupervisor, FFmpegLimitReached, FFMPEG_SPAWN_SECONDS
+from health import HealthMonitor, command_probe, directory_probe, disk_space_probe, first_line, OK, DEGRADED, DOWN
+from metrics import registry, MetricsServer
+from logs import setup_logging, traced, trace_mark, current_trace
+from config import DEBUG_CONFIG, MUSIC_CONFIG, CHAT_CONFIG, SHARD_CONFIG, HEALTH_CONFIG, METRICS_CONFIG
 
 # Bug of outdate yt-dlp
 import ssl
@@ -23,6 +41,11 @@ ssl._create_default_https_context = ssl.create_default_context(cafile=certifi.wh
 # Load environment variables from .env file
 load_dotenv()
 
+# Log records are written on a background thread from here on
+setup_logging()
+log = logging.getLogger("miku.music")
+chat_log = logging.getLogger("miku.chat")
+
 TOKEN = os.getenv('DISCORD_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
@@ -37,23 +60,61 @@ if not GEMINI_API_KEY:
     print("Get your key from: https://makersuite.google.com/app/apikey")
     exit(1)
 
+# Set by launcher.py when the shards are split across processes
+SHARD_IDS = os.getenv('SHARD_IDS')
+SHARD_COUNT = os.getenv('SHARD_COUNT')
+SHARD_PROCESS = os.getenv('SHARD_PROCESS')
+
+if SHARD_PROCESS is not None:
+    # Processes don't share state, so each keeps its own download cache
+    MUSIC_CONFIG["cache_dir"] = os.path.join(MUSIC_CONFIG["cache_dir"], f"process-{SHARD_PROCESS}")
+    # ...and its own metrics port
+    METRICS_CONFIG["port"] += int(SHARD_PROCESS)
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+def create_bot():
+    """Create the bot: sharded when launched per process or enabled in SHARD_CONFIG"""
+    options = {'command_prefix': "!", 'intents': intents, 'help_command': None}
+    if SHARD_IDS:
+        shard_ids = [int(shard_id) for shard_id in SHARD_IDS.split(',')]
+        return commands.AutoShardedBot(shard_ids=shard_ids, shard_count=int(SHARD_COUNT), **options)
+    if SHARD_CONFIG["enabled"]:
+        return commands.AutoShardedBot(shard_count=SHARD_CONFIG["shard_count"], **options)
+    return commands.Bot(**options)
+
+bot = create_bot()
 
 # Initialize AI chat system
-miku_ai = MikuChatAI()
+if SHARD_PROCESS is not None:
+    # History is per user, but a user's servers can land on different processes. Each process
+    # writes its own file and starts from everything saved so far (including the single-process
+    # conversation_history.json), so memories made on one process reach the others on restart.
+    miku_ai = MikuChatAI(
+        history_file=f"conversation_history.process-{SHARD_PROCESS}.json",
+        history_sources=["conversation_history.json", *sorted(glob.glob("conversation_history.process-*.json"))],
+    )
+else:
+    miku_ai = MikuChatAI()
+
+# Prometheus endpoint for the metrics every module records
+metrics_server = MetricsServer()
+DOWNLOAD_BYTES = registry.counter("miku_download_bytes_total", "Bytes of audio downloaded into the cache")
+QUEUE_DEPTH = registry.gauge("miku_queue_depth", "Songs waiting in each server's queue", ["guild"])
+
+# Bot status, updated in the background
+presence = PresenceManager(bot)
 
-# Create downloads folder if it doesn't exist
-if not os.path.exists('downloads'):
-    os.makedirs('downloads')
+# Download cache (also creates the downloads folder) and search/metadata cache
+download_cache = DownloadCache()
+metadata_cache = MetadataCache()
 
 # Updated yt-dlp options for better reliability
 ytdl_format_options = {
     'format': 'bestaudio/best',
-    'outtmpl': 'downloads/%(title)s.%(ext)s',
+    'outtmpl': os.path.join(MUSIC_CONFIG["cache_dir"], '%(extractor_key)s-%(id)s.%(ext)s'),
     'restrictfilenames': True,
     'noplaylist': True,
     'nocheckcertificate': True,
@@ -68,197 +129,1226 @@ ytdl_format_options = {
     'audioquality': '192K',
 }
 
+# Playlists are listed flat (IDs and titles only), each song is resolved when it comes up
+ytdl_playlist_options = {
+    **ytdl_format_options,
+    'noplaylist': False,
+    'extract_flat': 'in_playlist',
+}
+
 # Updated FFmpeg options (simplified and working)
 ffmpeg_options = {
     'before_options': '-nostdin',
     'options': '-vn'
 }
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+# Stream URLs can drop mid-song, so let FFmpeg reconnect before giving up
+ffmpeg_stream_options = {
+    'before_options': '-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-vn'
+}
+
+# Dedicated yt-dlp workers, kept apart from the default executor used by AI chat
+extraction_pool = ExtractionPool(ytdl_format_options, MUSIC_CONFIG["extraction_workers"])
+
+# Every FFmpeg process (players, frame encodes, loudness analysis) is started through here
+ffmpeg_supervisor = FFmpegSupervisor()
+background_ffmpeg = partial(ffmpeg_supervisor.spawn, kind="analysis", wait=True)
 
 # ===================
 # MUSIC QUEUE SYSTEM
 # ===================
 
+class Track:
+    """Lightweight description of a song; its FFmpeg player is only created when it starts playing"""
+    def __init__(self, data, *, guild_id=None, local_file=None, stream_url=None):
+        self.data = data
+        self.guild_id = guild_id
+        self.id = data.get('id')
+        self.title = data.get('title') or 'Unknown'
+        self.duration = data.get('duration')
+        self.webpage_url = data.get('webpage_url')
+        self.local_file = local_file
+        self.stream_url = stream_url
+        self.stream_expires = stream_url_expiry(stream_url) if stream_url else None
+        self.download_task = None
+        self.resume_attempts = 0
+
+    def stream_valid(self):
+        """Check that the stream URL won't expire before it can be used"""
+        return self.stream_url is not None and MetadataCache.stream_valid(self.stream_expires)
+
+    async def refresh(self):
+        """Resolve the track by its page URL, e.g. after its stream URL expired or for playlist entries"""
+        key = download_cache.key_for(self.data)
+        data = metadata_cache.get(key, need_stream=True) if key else None
+        if data is None:
+            log.info("🔄 Resolving stream URL for: %s", self.title)
+            url = self.webpage_url
+            data = await extraction_pool.run(self.guild_id, lambda ydl: ydl.extract_info(url, download=False))
+            if self.stream_url:
+                metadata_cache.refreshes += 1
+            metadata_cache.store(download_cache.key_for(data), data)
+        self.data = data
+        self.duration = data.get('duration')
+        self.stream_url = data['url']
+        self.stream_expires = stream_url_expiry(self.stream_url)
+
+    async def ensure_playable(self):
+        """Make sure the track has a local file or a stream URL that still works"""
+        if self.local_file and not os.path.exists(self.local_file):
+            # Evicted from the cache while it sat in the queue
+            self.local_file = None
+        if self.local_file is None and not self.stream_valid():
+            await self.refresh()
+
+    async def _download_in_background(self, loop):
+        """Download the track so replays and stream drops can use the local file"""
+        try:
+            if not self.stream_valid():
+                await self.refresh()
+            self.local_file = await download_track(self.data, guild_id=self.guild_id)
+            log.info("✅ Background download finished: %s", self.local_file)
+        except Exception as e:
+            log.warning("⚠️ Background download failed for %s: %s", self.title, e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+    def start_download(self, loop):
+        """Start downloading into the cache unless it's already downloaded or in progress"""
+        if self.local_file is None and (self.download_task is None or self.download_task.done()):
+            self.download_task = loop.create_task(self._download_in_background(loop))
+        return self.download_task
+
+    def cancel_download(self):
+        """Cancel a download that is still in progress"""
+        if self.download_task and not self.download_task.done():
+            self.download_task.cancel()
+            log.info("🚫 Cancelled download: %s", self.title)
+
 class MusicQueue:
-    """Simple music queue for each server"""
+    """Music queue for each server: a deque for O(1) play order, plus an index by video ID"""
     def __init__(self):
-        self.queue = []
+        self.queue = deque()
         self.current = None
+        self.by_id = {}
+    
+    def __len__(self):
+        return len(self.queue)
+    
+    def _index(self, track):
+        self.by_id.setdefault(track.id, []).append(track)
     
-    def add(self, song_data):
-        """Add song to queue"""
-        self.queue.append(song_data)
+    def _unindex(self, track):
+        tracks = self.by_id.get(track.id)
+        if tracks:
+            tracks.remove(track)
+            if not tracks:
+                del self.by_id[track.id]
+    
+    def add(self, track):
+        """Add track to queue and return its position"""
+        self.queue.append(track)
+        self._index(track)
+        return len(self.queue)
+    
+    def extend(self, tracks, position=None):
+        """Add several tracks at once, at the end or before a 1-based position"""
+        tracks = list(tracks)
+        if position is None or position > len(self.queue):
+            self.queue.extend(tracks)
+        else:
+            offset = max(position - 1, 0)
+            self.queue.rotate(-offset)
+            self.queue.extendleft(reversed(tracks))
+            self.queue.rotate(offset)
+        for track in tracks:
+            self._index(track)
     
     def next(self):
-        """Get next song from queue"""
+        """Get next track from queue"""
         if self.queue:
-            self.current = self.queue.pop(0)
+            self.current = self.queue.popleft()
+            self._unindex(self.current)
             return self.current
         self.current = None
         return None
     
+    def peek(self, count):
+        """Get the next few tracks without removing them"""
+        return list(islice(self.queue, count))
+    
+    def page(self, page, per_page=10):
+        """Get one page of the queue as (position, track) pairs, plus the page count"""
+        pages = max(1, -(-len(self.queue) // per_page))
+        page = min(max(page, 1), pages)
+        start = (page - 1) * per_page
+        entries = list(enumerate(islice(self.queue, start, start + per_page), start=start + 1))
+        return entries, pages
+    
+    def remove(self, position):
+        """Remove the track at a 1-based position"""
+        if not 1 <= position <= len(self.queue):
+            return None
+        track = self.queue[position - 1]
+        del self.queue[position - 1]
+        self._unindex(track)
+        return track
+    
+    def remove_id(self, video_id):
+        """Remove the first queued track with a video ID"""
+        tracks = self.by_id.get(video_id)
+        if not tracks:
+            return None
+        # by_id is in insertion order; positional extends, moves and shuffles reorder the deque
+        track = tracks[0] if len(tracks) == 1 else next(track for track in self.queue if track.id == video_id)
+        self.queue.remove(track)
+        self._unindex(track)
+        return track
+    
+    def move(self, source, destination):
+        """Move a track between 1-based positions"""
+        if not 1 <= source <= len(self.queue):
+            return None
+        track = self.queue[source - 1]
+        del self.queue[source - 1]
+        self.queue.insert(min(max(destination, 1), len(self.queue) + 1) - 1, track)
+        return track
+    
+    def shuffle(self):
+        """Shuffle the upcoming tracks"""
+        tracks = list(self.queue)
+        random.shuffle(tracks)
+        self.queue = deque(tracks)
+    
+    def dedupe(self):
+        """Drop repeated songs, keeping the first of each. Returns how many were removed."""
+        seen = set()
+        kept = deque()
+        for track in self.queue:
+            if track.id not in seen:
+                seen.add(track.id)
+                kept.append(track)
+        removed = len(self.queue) - len(kept)
+        self.queue = kept
+        self.by_id = {}
+        for track in kept:
+            self._index(track)
+        return removed
+    
     def clear(self):
         """Clear the queue"""
         self.queue.clear()
+        self.by_id.clear()
         self.current = None
     
     def is_empty(self):
         """Check if queue is empty"""
         return len(self.queue) == 0
 
-# Dictionary to store queues for each server
-music_queues = {}
+class Prefetcher:
+    """Downloads the next few queued tracks while the current one plays, for gapless transitions"""
+    def __init__(self, queue, loop):
+        self.queue = queue
+        self.loop = loop
+        self.tracks = set()
+    
+    def refresh(self):
+        """Prefetch the upcoming tracks and cancel work for tracks no longer coming up"""
+        upcoming = self.queue.peek(MUSIC_CONFIG["prefetch_count"])
+        
+        for track in list(self.tracks):
+            if track not in upcoming:
+                self.tracks.discard(track)
+                track.cancel_download()
+        
+        for track in upcoming:
+            if track.local_file is None:
+                track.start_download(self.loop)
+                self.tracks.add(track)
+    
+    def take(self, track):
+        """Hand a track over for playback so its download keeps going"""
+        self.tracks.discard(track)
+    
+    def cancel_all(self):
+        """Cancel every prefetch"""
+        for track in self.tracks:
+            track.cancel_download()
+        self.tracks.clear()
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
+class GuildState:
+    """Everything the music system keeps for one server: its queue, prefetcher, settings and live player"""
+    def __init__(self, guild_id, loop):
+        self.guild_id = guild_id
+        self.queue = MusicQueue()
+        self.prefetcher = Prefetcher(self.queue, loop)
+        self.settings = {
+            'playback_mode': MUSIC_CONFIG["playback_mode"],
+            'volume': MUSIC_CONFIG["default_volume"],
+        }
+        self.player = None          # The player the server is hearing (!volume and !seek swap it)
+        self.context = None         # Where music was last started from, to carry on after a reconnect
+        self.resume_point = None    # (track, seconds) of a song cut off by a disconnect
+        self.leaving = False        # Disconnecting on purpose, so it isn't taken for a dropped connection
+        self.reconnect_task = None
+        self.idle_since = None      # (reason, monotonic time) the connection was first seen idle
+        self.playlist_tasks = set() # Playlists still being listed into the queue
+        self.starting = False       # play_next has been started but hasn't set queue.current yet
+    
+    @property
+    def position(self):
+        """Seconds into the song the server is hearing, or None if nothing is playing"""
+        return self.player.position if self.player else None
+    
+    def clear(self):
+        """Clear the queue and cancel its prefetches and any playlist still being listed"""
+        for task in self.playlist_tasks:
+            task.cancel()
+        self.playlist_tasks.clear()
+        self.prefetcher.cancel_all()
+        self.queue.clear()
+
+# Music state is owned by the shard each server is on: shard_id -> {guild_id: GuildState}
+shard_states = {}
+
+def get_guild_state(guild):
+    """Get a server's music state from its shard, creating it on first use"""
+    states = shard_states.setdefault(guild.shard_id, {})
+    if guild.id not in states:
+        states[guild.id] = GuildState(guild.id, bot.loop)
+    return states[guild.id]
+
+def drop_guild_state(guild):
+    """Forget a server's music state, e.g. after the bot is removed from it"""
+    state = shard_states.get(guild.shard_id, {}).pop(guild.id, None)
+    if state:
+        state.clear()
+
+QUEUE_DEPTH.set_function(lambda: {
+    (guild_id,): len(state.queue)
+    for states in shard_states.values() for guild_id, state in states.items()
+})
+
+def format_time(seconds):
+    """Format seconds as m:ss or h:mm:ss"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+def parse_time(text):
+    """Parse 90, 1:30 or 1:02:03 into seconds, or None if it isn't a time (up to a day long)"""
+    try:
+        parts = [float(part) for part in text.strip().split(':')]
+    except ValueError:
+        return None
+    # float() also takes nan, inf and 1e9, none of which FFmpeg can seek to
+    if not 1 <= len(parts) <= 3 or any(not math.isfinite(part) or part < 0 for part in parts):
+        return None
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return seconds if seconds <= 24 * 60 * 60 else None
+
+class SupervisedFFmpeg:
+    """Mixin for discord.py FFmpeg sources: the process is started and reaped through ffmpeg_supervisor.
+    
+    Set guild_id before calling the source's __init__, which is where the process starts.
+    """
+    guild_id = None
+    
+    def _spawn_process(self, args, **subprocess_kwargs):
+        try:
+            process = ffmpeg_supervisor.spawn(args, guild_id=self.guild_id, owner=self, **subprocess_kwargs)
+            trace_mark("ffmpeg_started")
+            return process
+        except FileNotFoundError:
+            raise discord.ClientException(f"{args[0]} was not found.") from None
+        except FFmpegLimitReached as e:
+            raise discord.ClientException(str(e)) from e
+    
+    def _kill_process(self):
+        super()._kill_process()
+        if self._process is not discord.utils.MISSING:
+            ffmpeg_supervisor.release(self._process)
+
+class SupervisedFFmpegPCMAudio(SupervisedFFmpeg, discord.FFmpegPCMAudio):
+    """FFmpegPCMAudio whose process belongs to a server"""
+    def __init__(self, source, *, guild_id=None, **kwargs):
+        self.guild_id = guild_id
+        super().__init__(source, **kwargs)
+
+class TrackSource:
+    """Playback bookkeeping shared by every player the music system creates"""
+    trace = None
+    
+    def _init_track(self, track, *, streaming=False, start_offset=0.0, requested_at=None):
+        self.track = track
+        self.data = track.data
+        self.title = track.title
+        self.url = track.data.get('url')
+        self.streaming = streaming
+        self.stopped = False
+        self.start_offset = start_offset
+        self.requested_at = requested_at
+        self.frames_read = 0
+        # The command that started this player finishes its trace when the first frame is read
+        self.trace = current_trace()
+        if self.trace is not None:
+            self.trace.hand_off()
+        self.cache_key = download_cache.key_for(track.data)
+        if self.cache_key:
+            download_cache.pin(self.cache_key)
+
+    @property
+    def position(self):
+        """Seconds into the track that have been handed to the voice client"""
+        return self.start_offset + self.frames_read * 0.02
+
+    def read(self):
+        data = super().read()
+        if self.frames_read == 0 and data:
+            mode = "stream" if self.streaming else "download"
+            if self.requested_at is not None:
+                elapsed = (time.perf_counter() - self.requested_at) * 1000
+                log.info("⏱️ Time to first audio [%s]: %.0fms - %s", mode, elapsed, self.title)
+            if self.trace is not None:
+                self.trace.mark("first_frame")
+                self.trace.finish(mode=mode)
+        self.frames_read += 1
+        return data
+
+    def interrupted(self, error):
+        """Check whether the track ended before it should have (a dropped stream, FFmpeg dying, a disconnect)"""
+        if self.stopped:
+            return False
+        if error:
+            return True
+        duration = self.track.duration
+        return bool(duration) and self.position < duration - MUSIC_CONFIG["stream_drop_tolerance"]
+
+    def cleanup(self):
+        if self.trace is not None:
+            self.trace.finish("no_audio")
+        if self.cache_key:
+            download_cache.unpin(self.cache_key)
+            self.cache_key = None
+        super().cleanup()
+
+class YTDLSource(TrackSource, discord.PCMVolumeTransformer):
+    """Decodes to PCM so volume can be changed mid-song"""
+    
+    def __init__(self, source, *, track, volume=0.5, **track_options):
         super().__init__(source, volume)
-        self.data = data
-        self.title = data.get('title')
-        self.url = data.get('url')
+        self._init_track(track, **track_options)
 
     @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
+    async def from_url(cls, url, *, guild_id=None, loop=None, stream=False, volume=0.5, requested_at=None):
+        """Resolve a song and create its player straight away (a YTDLOpusSource when passthrough applies)"""
+        track = await resolve_track(url, guild_id=guild_id, loop=loop, stream=stream)
+        return create_player(track, volume=volume, requested_at=requested_at)
+
+class YTDLOpusSource(TrackSource, SupervisedFFmpeg, discord.FFmpegOpusAudio):
+    """Has FFmpeg apply the gain and encode Opus itself, so no audio passes through Python.
+    
+    The gain (volume times loudness normalization) is fixed for the life of the player;
+    !volume swaps in a new player at the current position. With passthrough (only used
+    when the gain is 1.0) an Opus source is copied untouched.
+    """
+    
+    def __init__(self, source, *, track, volume=0.5, gain=1.0, passthrough=False, before_options=None, **track_options):
+        self.guild_id = track.guild_id
+        if passthrough:
+            # discord.py turns codec 'opus' into '-c:a copy' (anything else means re-encoding with libopus)
+            super().__init__(source, codec='opus', before_options=before_options, options='-vn')
+        else:
+            super().__init__(source, before_options=before_options, options=f'-vn -af volume={gain:.3f}')
+        self.volume = volume
+        self.gain = gain
+        self._init_track(track, **track_options)
+
+class YTDLFrameSource(TrackSource, OpusFrameSource):
+    """Replays a cached song from its pre-encoded Opus frames, without starting FFmpeg.
+    
+    Like YTDLOpusSource, the gain is baked in, so frames are stored per gain.
+    """
+    
+    def __init__(self, path, *, track, volume=0.5, gain=1.0, start_offset=0.0, **track_options):
+        super().__init__(path, start_frame=int(start_offset / FRAME_SECONDS))
+        self.volume = volume
+        self.gain = gain
+        self._init_track(track, start_offset=start_offset, **track_options)
+
+# Frame files and loudness measurements run one at a time, off the event loop and away from extraction
+audio_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio-analysis")
+frame_builds = set()
+loudness_jobs = set()
+
+def frame_volume_key(gain):
+    """Frame files are stored per gain since the gain is baked into the packets"""
+    return str(round(gain * 100))
+
+async def build_frames(key, source_file, gain):
+    """Pre-encode a cached song's Opus frames at a gain for instant replays"""
+    volume_key = frame_volume_key(gain)
+    if (key, volume_key) in frame_builds:
+        return
+    frame_builds.add((key, volume_key))
+    
+    path = os.path.join(MUSIC_CONFIG["cache_dir"], f"{key}.v{volume_key}.mkop")
+    try:
+        frame_count = await bot.loop.run_in_executor(
+            audio_executor,
+            lambda: encode_frames(
+                source_file, path, volume=gain, bitrate=MUSIC_CONFIG["frame_store_bitrate"], spawn=background_ffmpeg
+            )
+        )
+        download_cache.add_frames(key, volume_key, path)
+        log.info("🧊 Stored %d Opus frames for %s at %s%% gain", frame_count, key, volume_key)
+    except Exception as e:
+        log.warning("⚠️ Failed to build Opus frames for %s: %s", key, e, exc_info=DEBUG_CONFIG["verbose_errors"])
+    finally:
+        frame_builds.discard((key, volume_key))
+
+async def analyse_loudness(key, source_file):
+    """Measure a cached song's loudness once, in the background, and store it in the cache index"""
+    if key in loudness_jobs:
+        return
+    loudness_jobs.add(key)
+    try:
+        loudness = await bot.loop.run_in_executor(
+            audio_executor, lambda: measure_loudness(source_file, spawn=background_ffmpeg)
+        )
+        download_cache.set_loudness(key, loudness)
+        log.info("📏 Measured %s at %.1f LUFS", key, loudness)
+    except Exception as e:
+        log.warning("⚠️ Failed to measure loudness of %s: %s", key, e, exc_info=DEBUG_CONFIG["verbose_errors"])
+    finally:
+        loudness_jobs.discard(key)
+
+def schedule_loudness(key, source_file):
+    """Queue a loudness measurement for a cached song that doesn't have one yet"""
+    if MUSIC_CONFIG["normalize_loudness"] and key and download_cache.loudness_for(key) is None:
+        bot.loop.create_task(analyse_loudness(key, source_file))
+
+def playback_gain(track, volume):
+    """Combine the server's volume with the song's loudness normalization into one gain"""
+    if not MUSIC_CONFIG["normalize_loudness"]:
+        return volume
+    key = download_cache.key_for(track.data)
+    loudness = download_cache.loudness_for(key) if key else None
+    if loudness is None:
+        return volume
+    gain_db = min(MUSIC_CONFIG["loudness_target"] - loudness, MUSIC_CONFIG["loudness_max_gain"])
+    return volume * 10 ** (gain_db / 20)
+
+def cache_key_for_url(url):
+    """Work out the cache key of a direct video link without touching the network"""
+    for ie_key in ('Youtube',):
+        ie = yt_dlp.extractor.get_info_extractor(ie_key)
+        if ie.suitable(url):
+            return download_cache.make_key(ie_key, ie.get_temp_id(url))
+    return None
+
+async def download_track(data, *, guild_id=None):
+    """Download an already extracted song into the cache and return its file"""
+    def run_download(ydl):
+        ydl.process_info(dict(data))
+        return ydl.prepare_filename(data)
+    
+    filename = await extraction_pool.run(guild_id, run_download)
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f"Downloaded file not found: {filename}")
+    DOWNLOAD_BYTES.inc(os.path.getsize(filename))
+    key = download_cache.key_for(data)
+    download_cache.add(key, filename, data)
+    schedule_loudness(key, filename)
+    return filename
+
+async def resolve_track(query, *, guild_id=None, loop=None, stream=False, defer_download=False):
+    """Turn a search or link into a Track, from the cache when possible.
+    
+    In stream mode the track keeps its stream URL and downloads in the background,
+    otherwise the download finishes before this returns. With defer_download the
+    download is left to the server's Prefetcher.
+    """
+    loop = loop or asyncio.get_event_loop()
+    
+    try:
+        # Direct links and repeat searches can be answered from the caches without any network
+        key = cache_key_for_url(query) or metadata_cache.lookup_query(query)
+        entry = download_cache.lookup(key) if key else None
+        data = metadata_cache.get(key, need_stream=True) if key and entry is None else None
         
-        try:
-            print(f"Extracting info for: {url}")
+        if entry is None and data is None:
+            # Known song with an expired stream URL: re-extract by page URL, skipping the search
+            known = metadata_cache.videos.get(key) if key else None
+            target = known["info"].get('webpage_url') or query if known else query
+            
+            log.info("Extracting info for: %s", target)
             # Extract info
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+            data = await extraction_pool.run(guild_id, lambda ydl: ydl.extract_info(target, download=False))
+            trace_mark("extracted")
             
             if 'entries' in data:
                 # Take first item from playlist
                 data = data['entries'][0]
-                print(f"Found video: {data.get('title', 'Unknown')}")
-            
-            if stream:
-                # For streaming, use the direct URL
-                filename = data['url']
-                print(f"Using stream URL: {filename}")
-            else:
-                # For downloading, use the filename
-                filename = ytdl.prepare_filename(data)
-                print(f"Downloaded to: {filename}")
-                
-                # Check if file exists
-                if not os.path.exists(filename):
-                    print(f"❌ Downloaded file not found: {filename}")
-                else:
-                    print(f"✅ Downloaded file exists: {filename}")
-            
-            print("Creating FFmpeg audio source...")
-            # Use absolute path to ensure file is found
-            abs_filename = os.path.abspath(filename)
-            print(f"Using absolute path: {abs_filename}")
-            
-            audio_source = discord.FFmpegPCMAudio(abs_filename, **ffmpeg_options)
-            print("✅ FFmpeg audio source created successfully")
+                log.info("Found video: %s", data.get('title', 'Unknown'))
             
-            return cls(audio_source, data=data)
+            key = download_cache.key_for(data)
+            if key:
+                metadata_cache.store(key, data, query=query)
+            if known:
+                metadata_cache.refreshes += 1
+            entry = download_cache.lookup(key) if key else None
         
-        except Exception as e:
-            print(f"❌ Error in YTDLSource.from_url: {e}")
-            import traceback
-            traceback.print_exc()
-            raise e
+        if entry is not None:
+            # Already downloaded earlier, no need to hit the stream
+            trace_mark("cache_hit")
+            log.info("💾 Using cached download: %s", entry['file'])
+            return Track(entry["info"], guild_id=guild_id, local_file=entry["file"])
+        
+        if stream or defer_download:
+            # For streaming, keep the direct URL and download in the background
+            log.debug("Using stream URL: %s", data['url'])
+            track = Track(data, guild_id=guild_id, stream_url=data['url'])
+            if not defer_download:
+                track.start_download(loop)
+            return track
+        
+        # For downloading, fetch the file into the cache first
+        filename = await download_track(data, guild_id=guild_id)
+        trace_mark("downloaded")
+        log.info("✅ Downloaded to: %s", filename)
+        return Track(data, guild_id=guild_id, local_file=filename)
+    
+    except Exception as e:
+        log.error("❌ Error resolving %s: %s", query, e, exc_info=True)
+        raise e
+
+def is_playlist_url(query):
+    """Check whether a link points at a YouTube playlist page.
+    
+    Song links copied from a playlist or mix (watch?v=...&list=...) play just that song.
+    """
+    parsed = urllib.parse.urlparse(query)
+    return (
+        parsed.path.rstrip('/') == '/playlist'
+        and 'list' in urllib.parse.parse_qs(parsed.query)
+        and yt_dlp.extractor.get_info_extractor('YoutubeTab').suitable(query)
+    )
+
+def track_from_playlist_entry(entry, guild_id):
+    """Build an unresolved Track from a flat playlist entry, using the download cache if it has the song"""
+    data = {
+        'id': entry.get('id'),
+        'title': entry.get('title'),
+        'duration': entry.get('duration'),
+        'extractor_key': entry.get('ie_key'),
+        'webpage_url': entry.get('url'),
+    }
+    key = download_cache.key_for(data)
+    cached = download_cache.entries.get(key) if key else None
+    if cached and os.path.exists(cached["file"]):
+        return Track(cached["info"], guild_id=guild_id, local_file=cached["file"])
+    return Track(data, guild_id=guild_id)
+
+async def ingest_playlist(url, *, guild_id, on_tracks):
+    """List a playlist flat and hand its tracks to on_tracks in batches as pages arrive.
+    
+    Returns (playlist title, number of tracks). The first track is handed over on its own
+    so playback can start while the rest of the playlist is still being listed.
+    """
+    loop = asyncio.get_running_loop()
+    max_tracks = MUSIC_CONFIG["playlist_max_tracks"]
+    batch_size = MUSIC_CONFIG["playlist_batch_size"]
+    
+    def deliver(entries):
+        on_tracks([track_from_playlist_entry(entry, guild_id) for entry in entries])
+    
+    def list_playlist(ydl):
+        with yt_dlp.YoutubeDL(ytdl_playlist_options) as flat_ydl:
+            info = flat_ydl.extract_info(url, download=False, process=False)
+            # Watch links with a list= parameter redirect to the playlist itself
+            while info.get('_type') in ('url', 'url_transparent'):
+                info = flat_ydl.extract_info(info['url'], download=False, process=False)
+            
+            batch = []
+            count = 0
+            for entry in info.get('entries') or []:
+                if current_job_cancelled() or count >= max_tracks:
+                    break
+                if not entry or not entry.get('url'):
+                    continue
+                batch.append(entry)
+                count += 1
+                if count == 1 or len(batch) >= batch_size:
+                    loop.call_soon_threadsafe(deliver, batch)
+                    batch = []
+            if batch:
+                loop.call_soon_threadsafe(deliver, batch)
+            return info.get('title') or 'playlist', count
+    
+    log.info("📜 Listing playlist: %s", url)
+    return await extraction_pool.run(guild_id, list_playlist)
+
+def is_opus_passthrough(data):
+    """Check whether a source is already Opus at a bitrate worth passing through"""
+    if not MUSIC_CONFIG["opus_passthrough"]:
+        return False
+    return data.get('acodec') == 'opus' and (data.get('abr') or 0) >= MUSIC_CONFIG["opus_min_bitrate"]
+
+def create_player(track, *, volume=0.5, start=0.0, requested_at=None, new_play=False):
+    """Create the player for a track: stored Opus frames, then the downloaded file, then the stream URL.
+    
+    The server's volume and the song's loudness normalization are applied together as one gain.
+    new_play counts the play towards building stored frames; seeks, volume changes and resumes don't.
+    """
+    streaming = track.local_file is None
+    location = track.stream_url if streaming else os.path.abspath(track.local_file)
+    
+    options = ffmpeg_stream_options if streaming else ffmpeg_options
+    before_options = options['before_options']
+    if start:
+        before_options = f"-ss {start:.2f} {before_options}"
+    
+    track_options = {
+        'streaming': streaming,
+        'start_offset': start,
+        'requested_at': requested_at,
+    }
+    
+    # Opus sources are copied as-is only when there's nothing to change: volume 100% and no correction
+    gain = playback_gain(track, volume)
+    passthrough = is_opus_passthrough(track.data) and round(gain, 3) == 1.0
+    if not streaming:
+        # Songs cached before loudness was measured get measured on their next play
+        schedule_loudness(download_cache.key_for(track.data), location)
+    
+    if not streaming and MUSIC_CONFIG["frame_store"]:
+        # Songs replayed often are served from pre-encoded frames, built after enough plays
+        key = download_cache.key_for(track.data)
+        frames = download_cache.frames_for(key, frame_volume_key(gain)) if key else None
+        if frames:
+            return YTDLFrameSource(frames, track=track, volume=volume, gain=gain, **track_options)
+        if key and new_play and download_cache.record_play(key) >= MUSIC_CONFIG["frame_store_min_plays"]:
+            bot.loop.create_task(build_frames(key, location, gain))
+    
+    if MUSIC_CONFIG["volume_mode"] == "ffmpeg" or passthrough:
+        return YTDLOpusSource(
+            location, track=track, volume=volume, gain=gain, passthrough=passthrough,
+            before_options=before_options, **track_options
+        )
+    
+    audio_source = SupervisedFFmpegPCMAudio(
+        location, guild_id=track.guild_id, before_options=before_options, options=options['options']
+    )
+    return YTDLSource(audio_source, track=track, volume=gain, **track_options)
 
 # ===================
 # UTILITY FUNCTIONS
 # ===================
 
-def cleanup_old_downloads():
-    """Remove downloaded files older than 1 hour"""
-    try:
-        downloads_dir = 'downloads'
-        if not os.path.exists(downloads_dir):
+def stop_playback(voice_client):
+    """Stop the current player without it being mistaken for a dropped stream"""
+    if isinstance(voice_client.source, TrackSource):
+        voice_client.source.stopped = True
+        voice_client.source.track.cancel_download()
+    voice_client.stop()
+
+def start_playback(ctx, player):
+    """Start a player on the voice client and chain to the next song when it ends"""
+    state = get_guild_state(ctx.guild)
+    state.player = player
+    state.context = ctx
+    
+    def after_playing(error):
+        if error:
+            log.error("❌ Playback error: %s", error)
+        # The player may have been swapped by !volume or !seek since it started
+        current = state.player or player
+        state.player = None
+        asyncio.run_coroutine_threadsafe(handle_track_end(ctx, current, error), bot.loop)
+    
+    ctx.voice_client.play(player, after=after_playing)
+
+def swap_player(ctx, player):
+    """Hand the voice client a new player for the same song, from the next frame on"""
+    voice_client = ctx.voice_client
+    old = voice_client.source
+    was_paused = voice_client.is_paused()
+    
+    get_guild_state(ctx.guild).player = player
+    voice_client.source = player
+    if was_paused:
+        voice_client.pause()
+    
+    old.stopped = True
+    # The audio thread may still be finishing a read from the old player
+    bot.loop.call_later(1, old.cleanup)
+
+async def resume_track(ctx, track, position):
+    """Restart a song part way through from the downloaded file or its stream URL, without searching again"""
+    state = get_guild_state(ctx.guild)
+    await track.ensure_playable()
+    player = create_player(track, start=position, volume=state.settings['volume'])
+    start_playback(ctx, player)
+    state.queue.current = track
+    presence.track_started(ctx.guild.id, track.title)
+    return player
+
+async def handle_track_end(ctx, player, error):
+    """Pick an interrupted song back up where it stopped, otherwise play the next song"""
+    if player.interrupted(error):
+        track = player.track
+        if not ctx.voice_client:
+            # Lost the connection; resume once the bot is back in a channel
+            get_guild_state(ctx.guild).resume_point = (track, player.position)
+            log.info("💾 Saved position %s of %s", format_time(player.position), track.title)
             return
         
-        cutoff_time = time.time() - 3600  # 1 hour ago
-        removed = 0
-        
-        for file_path in glob.glob(f"{downloads_dir}/*"):
+        if track.resume_attempts < MUSIC_CONFIG["resume_max_attempts"]:
+            track.resume_attempts += 1
             try:
-                if os.path.getmtime(file_path) < cutoff_time:
-                    os.remove(file_path)
-                    removed += 1
+                log.warning("🔁 Playback interrupted at %.0fs, resuming %s", player.position, track.title)
+                await resume_track(ctx, track, player.position)
+                return
             except Exception as e:
-                if DEBUG_CONFIG["verbose_errors"]:
-                    print(f"⚠️ Failed to remove {file_path}: {e}")
-        
-        if removed > 0:
-            print(f"🗑️ Cleaned up {removed} old download(s)")
-    except Exception as e:
-        print(f"⚠️ Cleanup error: {e}")
+                log.error("❌ Failed to resume %s: %s", track.title, e, exc_info=DEBUG_CONFIG["verbose_errors"])
+    
+    await play_next(ctx)
 
 async def play_next(ctx):
     """Play the next song in queue"""
     guild_id = ctx.guild.id
+    state = get_guild_state(ctx.guild)
     
-    if guild_id not in music_queues or music_queues[guild_id].is_empty():
+    if state.queue.is_empty():
         # Queue is empty, reset status
-        await bot.change_presence(activity=discord.Game(name="🎵 Music & AI Chat | !help"))
+        state.queue.current = None
+        presence.track_stopped(guild_id)
         return
     
-    try:
-        next_song = music_queues[guild_id].next()
-        if next_song and ctx.voice_client:
-            player = next_song['player']
-            
-            def after_callback(error):
-                if error:
-                    print(f'❌ Playback error: {error}')
-                asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+    with traced("play_next", guild=guild_id) as trace:
+        try:
+            requested_at = time.perf_counter()
+            while True:
+                track = state.queue.next()
+                if track:
+                    state.prefetcher.take(track)
+                state.prefetcher.refresh()
+                if not (track and ctx.voice_client):
+                    break
+                
+                # Swap in a fresh stream URL if it expired while the track was queued
+                try:
+                    await track.ensure_playable()
+                    break
+                except Exception as e:
+                    # Private, deleted or blocked entries are common in playlists; skip to the next one
+                    log.warning("⏭️ Skipping %s: %s", track.title, e)
+                    state.queue.current = None
+                    await ctx.send(f"⏭️ Skipped **{track.title}**, it can't be played")
             
-            ctx.voice_client.play(player, after=after_callback)
+            if track and ctx.voice_client:
+                settings = state.settings
+                
+                # Wait for the prefetch in download mode, otherwise stream while it finishes
+                if track.local_file is None:
+                    download_task = track.start_download(bot.loop)
+                    if settings['playback_mode'] == 'download':
+                        await download_task
+                
+                # FFmpeg only starts now, so queued songs don't hold idle processes
+                player = create_player(track, volume=settings['volume'], requested_at=requested_at, new_play=True)
+                
+                start_playback(ctx, player)
+                
+                # Update bot status
+                presence.track_started(guild_id, track.title)
+                
+                await ctx.send(f"🎵 Now playing: **{track.title}**")
+            elif track is None:
+                # Every remaining entry was skipped
+                presence.track_stopped(guild_id)
+        except Exception as e:
+            trace.finish("error", error=e.__class__.__name__)
+            log.error("❌ Error in play_next: %s", e)
+            # Nothing is playing, so the next !play or playlist batch can start playback again
+            state.queue.current = None
+            await ctx.send("❌ Failed to play next song!")
+
+# ===================
+# VOICE CONNECTION UPKEEP
+# ===================
+
+idle_monitor_task = None
+
+voice_stats = {"reconnects": 0, "reconnect_failures": 0, "reclaimed": 0}
+
+async def disconnect_voice(voice_client):
+    """Leave voice on purpose, dropping the queue and saved position and stopping FFmpeg"""
+    state = get_guild_state(voice_client.guild)
+    state.leaving = True
+    state.clear()
+    state.resume_point = None
+    stop_playback(voice_client)
+    await voice_client.disconnect()
+    ffmpeg_supervisor.kill_guild(voice_client.guild.id)
+    presence.track_stopped(voice_client.guild.id)
+
+async def reconnect_voice(guild, channel):
+    """Rejoin a channel after an unexpected disconnect, backing off between attempts, then carry on playing"""
+    state = get_guild_state(guild)
+    delay = MUSIC_CONFIG["reconnect_backoff"]
+    for attempt in range(1, MUSIC_CONFIG["reconnect_attempts"] + 1):
+        await asyncio.sleep(delay)
+        if guild.voice_client is not None:
+            # Someone already brought the bot back with !join or !play
+            return
+        try:
+            await channel.connect()
+            break
+        except Exception as e:
+            log.warning("⚠️ Reconnect attempt %d to %s failed: %s", attempt, channel.name, e)
+            delay = min(delay * 2, MUSIC_CONFIG["reconnect_backoff_max"])
+    else:
+        voice_stats["reconnect_failures"] += 1
+        log.error("❌ Gave up reconnecting to voice in guild %s, clearing queue", guild.id)
+        state.clear()
+        state.resume_point = None
+        ffmpeg_supervisor.kill_guild(guild.id)
+        presence.track_stopped(guild.id)
+        return
+    
+    voice_stats["reconnects"] += 1
+    log.info("🔌 Reconnected to %s in guild %s", channel.name, guild.id)
+    
+    ctx = state.context
+    if ctx is None:
+        return
+    try:
+        point, state.resume_point = state.resume_point, None
+        if point:
+            track, position = point
+            await resume_track(ctx, track, position)
+        elif not state.queue.is_empty():
+            await play_next(ctx)
+    except Exception as e:
+        log.error("❌ Failed to carry on playing after reconnect: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+async def removed_from_voice(guild, channel):
+    """Check whether the bot was put out of voice on purpose: its channel was deleted or a moderator
+    disconnected it. Without audit log access that can't be ruled out, so it counts as removed."""
+    if guild.get_channel(channel.id) is None:
+        return True
+    if not guild.me.guild_permissions.view_audit_log:
+        return True
+    cutoff = discord.utils.utcnow() - timedelta(seconds=MUSIC_CONFIG["reconnect_audit_window"])
+    try:
+        async for entry in guild.audit_logs(limit=5, action=discord.AuditLogAction.member_disconnect):
+            if entry.created_at >= cutoff:
+                return True
+    except discord.HTTPException:
+        return True
+    return False
+
+async def recover_voice(guild, channel):
+    """After losing voice without !leave, rejoin if the connection dropped.
+    
+    discord.py already reconnects through short network drops itself, so this mostly sees
+    moderators and deleted channels. Then the bot stays out, keeping the queue and position for
+    the next !join or !play.
+    """
+    if await removed_from_voice(guild, channel):
+        log.info("🔌 Removed from voice in guild %s, keeping the queue for the next !join", guild.id)
+        presence.track_stopped(guild.id)
+        return
+    log.warning("🔌 Lost voice connection in guild %s, reconnecting...", guild.id)
+    await reconnect_voice(guild, channel)
+
+def idle_reason(voice_client):
+    """Work out whether a voice connection is idle, as (reason, timeout) or (None, None)"""
+    if not any(not member.bot for member in voice_client.channel.members):
+        return "because everyone left", MUSIC_CONFIG["empty_channel_timeout"]
+    if not voice_client.is_playing():
+        return "after nothing played for a while", MUSIC_CONFIG["idle_timeout"]
+    return None, None
+
+async def idle_monitor():
+    """Disconnect from channels nobody is listening in, or where nothing has played for a while"""
+    while True:
+        await asyncio.sleep(MUSIC_CONFIG["idle_check_interval"])
+        now = time.monotonic()
+        
+        for voice_client in list(bot.voice_clients):
+            state = get_guild_state(voice_client.guild)
+            reason, timeout = idle_reason(voice_client)
+            if reason is None:
+                state.idle_since = None
+                continue
             
-            # Update bot status
-            await bot.change_presence(
-                activity=discord.Activity(
-                    type=discord.ActivityType.listening,
-                    name=next_song['title'][:128]
-                )
-            )
+            seen_reason, since = state.idle_since or (None, now)
+            if seen_reason != reason:
+                state.idle_since = (reason, now)
+                continue
+            if now - since < timeout:
+                continue
             
-            await ctx.send(f"🎵 Now playing: **{next_song['title']}**")
-    except Exception as e:
-        print(f"❌ Error in play_next: {e}")
-        await ctx.send("❌ Failed to play next song!")
+            state.idle_since = None
+            channel_name = voice_client.channel.name
+            try:
+                await disconnect_voice(voice_client)
+                voice_stats["reclaimed"] += 1
+                log.info("💤 Left %s in guild %s %s", channel_name, state.guild_id, reason)
+                ctx, state.context = state.context, None
+                if ctx:
+                    await ctx.send(f"👋 Left **{channel_name}** {reason}")
+            except Exception as e:
+                log.error("❌ Failed to leave idle channel %s: %s", channel_name, e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+# ===================
+# HEALTH CHECKS
+# ===================
+
+def ffmpeg_version():
+    """Run ffmpeg -version through the supervisor like any other FFmpeg process (blocks; use an executor)"""
+    process = ffmpeg_supervisor.spawn(
+        ['ffmpeg', '-version'], kind="probe",
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    try:
+        stdout, _ = process.communicate(timeout=HEALTH_CONFIG["probe_timeout"])
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        ffmpeg_supervisor.release(process)
+    return process.returncode, stdout.decode('utf-8', errors='replace')
+
+async def probe_ffmpeg():
+    """FFmpeg runs, and the supervisor still has room for more processes"""
+    try:
+        returncode, output = await bot.loop.run_in_executor(None, ffmpeg_version)
+    except FileNotFoundError:
+        return DOWN, "ffmpeg is not installed or not in PATH"
+    except FFmpegLimitReached:
+        return DEGRADED, f"all {ffmpeg_supervisor.max_processes} process slots are in use"
+    if returncode != 0:
+        return DOWN, f"ffmpeg exited with code {returncode}"
+    status, detail = OK, first_line(output)
+    stats = ffmpeg_supervisor.get_stats()
+    if status == OK and stats['live'] >= stats['max_processes']:
+        return DEGRADED, f"{detail}, but all {stats['max_processes']} process slots are in use"
+    return status, detail
+
+async def probe_extractor():
+    """A known video resolves through the extraction pool, and the pool isn't backed up"""
+    url = HEALTH_CONFIG["extractor_probe_url"]
+    data = await extraction_pool.run("health", lambda ydl: ydl.extract_info(url, download=False, process=False))
+    p95_wait = extraction_pool.get_stats()['p95_wait']
+    if p95_wait > HEALTH_CONFIG["extraction_wait_warn"]:
+        return DEGRADED, f"resolving works, but queue wait p95 is {p95_wait:.1f}s"
+    return OK, f"yt-dlp {yt_dlp.version.__version__} resolved \"{data.get('title', url)}\""
+
+async def probe_ai():
+    """The Gemini API answers"""
+    if not miku_ai.initialized:
+        return DOWN, "not initialized"
+    return OK, await miku_ai.check_backend()
+
+health = HealthMonitor()
+health.register("FFmpeg", probe_ffmpeg)
+health.register("Download folder", directory_probe(MUSIC_CONFIG["cache_dir"]))
+health.register("Disk space", disk_space_probe(MUSIC_CONFIG["cache_dir"], HEALTH_CONFIG["min_free_disk"]))
+health.register("Extractor", probe_extractor, interval=HEALTH_CONFIG["extractor_interval"])
+health.register("AI backend", probe_ai, interval=HEALTH_CONFIG["ai_interval"])
+# Local audio isn't needed for Discord playback, so these are informational
+health.register("PulseAudio", command_probe(['pactl', 'info']), required=False)
+health.register("ALSA", command_probe(['aplay', '-l']), required=False)
+
+HEALTH_ICONS = {OK: "✅", DEGRADED: "⚠️", DOWN: "❌"}
 
 @bot.event
 async def on_ready():
-    print(f"✅ MikuChan is online as {bot.user}")
+    log.info("✅ MikuChan is online as %s", bot.user)
+    if bot.shard_count:
+        log.info("🧩 Running shards %s of %s", sorted(bot.shards), bot.shard_count)
+    
+    # Keep the download cache under quota in the background
+    log.info("🗑️ Starting download cache eviction...")
+    download_cache.start_eviction()
+    download_cache.start_autosave()
+    ffmpeg_supervisor.start_reaper()
+    metadata_cache.start_autosave()
     
-    # Cleanup old downloads on startup
-    print("🗑️ Cleaning up old downloads...")
-    cleanup_old_downloads()
+    # Free voice connections nobody is using
+    global idle_monitor_task
+    if idle_monitor_task is None or idle_monitor_task.done():
+        idle_monitor_task = bot.loop.create_task(idle_monitor())
     
     # Initialize AI chat system
-    print("🤖 Initializing AI chat system...")
+    chat_log.info("🤖 Initializing AI chat system...")
     ai_success = await miku_ai.initialize(GEMINI_API_KEY)
     
     if ai_success:
-        print("✅ AI chat system ready!")
-        await bot.change_presence(activity=discord.Game(name="🎵 Music & AI Chat | !help"))
+        chat_log.info("✅ AI chat system ready!")
+        presence.set_idle_name("🎵 Music & AI Chat | !help")
     else:
-        print("❌ AI chat system failed to initialize")
-        await bot.change_presence(activity=discord.Game(name="🎵 Music Only | !help"))
+        chat_log.error("❌ AI chat system failed to initialize")
+        presence.set_idle_name("🎵 Music Only | !help")
+    presence.start()
+    
+    # Probe FFmpeg, storage, the extractor and the AI backend in the background
+    health.start()
+    
+    if METRICS_CONFIG["enabled"]:
+        await metrics_server.start()
+
+@bot.event
+async def on_shard_ready(shard_id):
+    log.info("🧩 Shard %s ready with %d servers holding music state", shard_id, len(shard_states.get(shard_id, {})))
+
+@bot.event
+async def on_guild_remove(guild):
+    """Forget a server's queue and settings once the bot is removed from it"""
+    drop_guild_state(guild)
 
 @bot.event
 async def on_voice_state_update(member, before, after):
     """Handle voice state changes"""
-    # If bot was disconnected, clean up queue
-    if member == bot.user and before.channel and not after.channel:
-        guild_id = member.guild.id
-        if guild_id in music_queues:
-            music_queues[guild_id].clear()
-            print(f"🔌 Disconnected from voice, cleared queue for guild {guild_id}")
-        # Reset status
-        await bot.change_presence(activity=discord.Game(name="🎵 Music & AI Chat | !help"))
+    if member != bot.user:
+        return
+    guild_id = member.guild.id
+    state = get_guild_state(member.guild)
+    
+    if before.channel and not after.channel:
+        state.idle_since = None
+        if state.leaving or not MUSIC_CONFIG["auto_reconnect"]:
+            # Left on purpose, clean up queue
+            state.leaving = False
+            state.clear()
+            log.info("🔌 Disconnected from voice, cleared queue for guild %s", guild_id)
+            # Reset status
+            presence.track_stopped(guild_id)
+        elif state.reconnect_task is None or state.reconnect_task.done():
+            # Not by !leave: keep the queue and position, and rejoin unless someone removed the bot
+            state.reconnect_task = bot.loop.create_task(recover_voice(member.guild, before.channel))
+    elif after.channel:
+        state.leaving = False
 
 # ===================
 # AI CHAT COMMANDS
 # ===================
 
+# Chat requests still being answered, by the messages that asked, so deleting one abandons the request
+pending_chats = {}
+
+# Quick runs of messages from one user in one channel are answered together
+chat_bursts = ChatCoalescer()
+
+@contextmanager
+def cancellable_chat(*messages):
+    """Let the current chat request be cancelled by deleting a message that asked for it"""
+    task = asyncio.current_task()
+    for message in messages:
+        pending_chats[message.id] = task
+    try:
+        yield
+    finally:
+        for message in messages:
+            pending_chats.pop(message.id, None)
+
+class StreamedReply:
+    """A chat reply posted as soon as its first sentence is ready, with the rest edited in.
+    
+    Edits are spaced at least CHAT_CONFIG["edit_interval"] apart, and text arriving in between
+    is folded into the next edit, so a fast stream can't run into Discord's edit rate limit.
+    Edits go out one at a time, so a streamed edit can never land after the final text.
+    """
+    def __init__(self, send):
+        self.send = send
+        self.message = None
+        self.shown = ""
+        self.pending = None
+        self.last_edit = 0.0
+        self.edit_task = None
+        self._edit_lock = asyncio.Lock()
+    
+    async def update(self, text):
+        if self.message is None:
+            self.message = await self.send(text)
+            self.shown = text
+            self.last_edit = time.monotonic()
+            return
+        self.pending = text
+        if self.edit_task is None:
+            self.edit_task = asyncio.create_task(self._edit_later())
+    
+    async def _edit_later(self):
+        try:
+            # Text that arrives while an edit is in flight goes out in the next one
+            while self.pending != self.shown:
+                await asyncio.sleep(max(0.0, self.last_edit + CHAT_CONFIG["edit_interval"] - time.monotonic()))
+                # Shielded so close() can't abandon a request Discord may still apply
+                await asyncio.shield(self._edit(self.pending))
+        finally:
+            if self.edit_task is asyncio.current_task():
+                self.edit_task = None
+    
+    async def _edit(self, text):
+        async with self._edit_lock:
+            if text == self.shown:
+                return
+            self.shown = text
+            self.last_edit = time.monotonic()
+            await self.message.edit(content=text)
+    
+    async def finish(self, text):
+        """Show the final text, replacing whatever was streamed"""
+        self.close()
+        if self.message is None:
+            self.message = await self.send(text)
+        else:
+            await self._edit(text)
+    
+    def close(self):
+        if self.edit_task is not None:
+            self.edit_task.cancel()
+            self.edit_task = None
+
+async def answer_chat(ctx, burst):
+    """Generate one chat reply to a burst of messages and post it the way its latest message asked
+    (ctx.send or ctx.reply). Returns whether it succeeded."""
+    message, send = burst.text, burst.send
+    user_id = str(ctx.author.id)
+    display_name = ctx.author.display_name
+    username = ctx.author.name
+    
+    if not CHAT_CONFIG["stream_responses"]:
+        response, success = await miku_ai.generate_response(message, user_id, display_name, username)
+        await send(response)  # Error message is already friendly
+        return success
+    
+    reply = StreamedReply(send)
+    try:
+        response, success = await miku_ai.generate_response(
+            message, user_id, display_name, username, on_partial=reply.update
+        )
+        await reply.finish(response)
+    finally:
+        reply.close()
+    return success
+
+@bot.event
+async def on_raw_message_delete(payload):
+    """Stop working on a chat reply nobody is waiting for any more"""
+    task = pending_chats.pop(payload.message_id, None)
+    if task is not None:
+        chat_log.info("🗑️ Message %s deleted, abandoning its chat request", payload.message_id)
+        task.cancel()
+
 @bot.command(aliases=['c', 'talk'])
 async def chat(ctx, *, message):
     """Chat with MikuChan AI! Usage: !chat <your message>"""
@@ -267,30 +1357,26 @@ async def chat(ctx, *, message):
         return
     
     # Show typing indicator
-    async with ctx.typing():
-        try:
-            # Get user info
-            user_id = str(ctx.author.id)
-            display_name = ctx.author.display_name
-            username = ctx.author.name
-            
-            if DEBUG_CONFIG["log_ai_requests"]:
-                print(f"💬 Chat request from {display_name}: {message[:100]}...")
-            
-            # Generate AI response
-            response, success = await miku_ai.generate_response(
-                message, user_id, display_name, username
-            )
-            
-            if success:
-                await ctx.send(response)
-            else:
-                await ctx.send(response)  # Error message is already friendly
+    burst_key = (ctx.author.id, ctx.channel.id)
+    async with ctx.typing(), chat_bursts.collect(burst_key, ctx.message, message, ctx.send) as burst:
+        if burst is None:
+            # Answered together with the user's message just before this one
+            return
+        
+        guild_id = ctx.guild.id if ctx.guild else None
+        with traced("chat", guild=guild_id, messages=len(burst.messages)) as trace, cancellable_chat(*burst.messages):
+            try:
+                chat_log.info("💬 Chat request from %s: %.100s...", ctx.author.display_name, burst.text)
                 
-        except Exception as e:
-            if DEBUG_CONFIG["verbose_errors"]:
-                print(f"❌ Chat command error: {e}")
-            await ctx.send("Oops, something went wrong while I was thinking... 🤖✨")
+                # Generate AI response, streamed into the channel as it's written
+                success = await answer_chat(ctx, burst)
+                trace.mark("sent")
+                trace.finish("ok" if success else "fallback")
+                    
+            except Exception as e:
+                trace.finish("error", error=e.__class__.__name__)
+                chat_log.error("❌ Chat command error: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+                await burst.send("Oops, something went wrong while I was thinking... 🤖✨")
 
 @bot.command()
 async def aistats(ctx):
@@ -312,14 +1398,38 @@ async def aistats(ctx):
         embed.add_field(name="Total Conversations", value=f"{stats['total_conversations']}", inline=True)
         embed.add_field(name="Active Users", value=f"{stats['active_users']}", inline=True)
         embed.add_field(name="Known Members", value=f"{stats['known_members']}", inline=True)
+        embed.add_field(
+            name="Gemini Requests",
+            value=f"{stats['requests']} ({stats['error_rate']:.1%} errors, {stats['in_flight']} in flight)",
+            inline=True
+        )
+        embed.add_field(
+            name="Response Time",
+            value=f"avg {stats['latency']['avg']:.2f}s, p95 {stats['latency']['p95']:.2f}s",
+            inline=True
+        )
+        embed.add_field(name="Rate Limited", value=f"{stats['rate_limited']}", inline=True)
+        cache = stats['response_cache']
+        embed.add_field(
+            name="Response Cache",
+            value=f"{cache['hit_rate']:.1%} hit rate ({cache['hits']} of {cache['hits'] + cache['misses']})",
+            inline=True
+        )
+        embed.add_field(name="History Save (p95)", value=f"{stats['history_save']['p95'] * 1000:.1f}ms", inline=True)
+        embed.add_field(
+            name="Music Hot Paths (p95)",
+            value=(f"extraction {EXTRACTION_SECONDS.summary()['p95']:.2f}s, "
+                   f"FFmpeg start {FFMPEG_SPAWN_SECONDS.summary()['p95'] * 1000:.1f}ms, "
+                   f"{DOWNLOAD_BYTES.total() / 1024**2:.0f} MB downloaded"),
+            inline=False
+        )
         
         embed.set_footer(text="MikuChan AI powered by Gemini")
         
         await ctx.send(embed=embed)
         
     except Exception as e:
-        if DEBUG_CONFIG["verbose_errors"]:
-            print(f"❌ AI stats error: {e}")
+        chat_log.error("❌ AI stats error: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
         await ctx.send("❌ Failed to get AI statistics!")
 
 # ===================
@@ -334,6 +1444,16 @@ async def join(ctx):
         if ctx.voice_client is None:
             await channel.connect()
             await ctx.send("🎶 MikuChan joined the voice channel!")
+            
+            state = get_guild_state(ctx.guild)
+            point, state.resume_point = state.resume_point, None
+            if point:
+                track, position = point
+                try:
+                    await resume_track(ctx, track, position)
+                    await ctx.send(f"▶️ Picking up **{track.title}** from {format_time(position)}")
+                except Exception as e:
+                    log.error("❌ Failed to resume %s: %s", track.title, e, exc_info=DEBUG_CONFIG["verbose_errors"])
         else:
             await ctx.send("🎶 MikuChan is already in a voice channel!")
     else:
@@ -342,69 +1462,115 @@ async def join(ctx):
 @bot.command()
 async def play(ctx, *, query):
     """Play a song from YouTube or add to queue"""
-    if not ctx.voice_client:
-        if ctx.author.voice:
-            await ctx.author.voice.channel.connect()
-        else:
-            await ctx.send("❌ You're not in a voice channel!")
-            return
+    with traced("play", guild=ctx.guild.id) as trace:
+        requested_at = time.perf_counter()
+        if not ctx.voice_client:
+            if ctx.author.voice:
+                await ctx.author.voice.channel.connect()
+            else:
+                await ctx.send("❌ You're not in a voice channel!")
+                return
 
-    # Initialize queue for this guild if needed
-    guild_id = ctx.guild.id
-    if guild_id not in music_queues:
-        music_queues[guild_id] = MusicQueue()
+        guild_id = ctx.guild.id
+        state = get_guild_state(ctx.guild)
 
-    async with ctx.typing():
-        try:
-            print(f"Searching for: {query}")
-            player = await YTDLSource.from_url(query, loop=bot.loop, stream=False)
-            print(f"Successfully created player for: {player.title}")
-            
-            # If something is playing, add to queue
-            if ctx.voice_client.is_playing():
-                music_queues[guild_id].add({'player': player, 'title': player.title})
-                position = len(music_queues[guild_id].queue)
-                await ctx.send(f"➕ Added to queue: **{player.title}**\nPosition: #{position}")
-            else:
-                # Play immediately
-                def after_playing(error):
-                    if error:
-                        print(f'❌ Playback error: {error}')
-                    asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
-                
-                ctx.voice_client.play(player, after=after_playing)
-                music_queues[guild_id].current = player.title
-                
-                # Update bot status
-                await bot.change_presence(
-                    activity=discord.Activity(
-                        type=discord.ActivityType.listening,
-                        name=player.title[:128]
-                    )
+        if is_playlist_url(query):
+            await play_playlist(ctx, query)
+            return
+
+        async with ctx.typing():
+            try:
+                log.info("Searching for: %s", query)
+                settings = state.settings
+                track = await resolve_track(
+                    query, guild_id=guild_id, loop=bot.loop, stream=settings['playback_mode'] == 'stream',
+                    defer_download=ctx.voice_client.is_playing()
                 )
+                log.info("Successfully resolved: %s", track.title)
                 
-                await asyncio.sleep(1)
+                # If something is playing, add to queue
                 if ctx.voice_client.is_playing():
-                    await ctx.send(f"🎵 Now playing: **{player.title}**")
+                    position = state.queue.add(track)
+                    state.prefetcher.refresh()
+                    await ctx.send(f"➕ Added to queue: **{track.title}**\nPosition: #{position}")
+                    trace.finish("queued")
                 else:
-                    await ctx.send(f"❌ Failed to play: **{player.title}**")
-                
-        except Exception as e:
-            await ctx.send(f"❌ An error occurred: {str(e)}")
-            print(f"Play command error: {e}")
-            import traceback
-            traceback.print_exc()
+                    # Play immediately
+                    player = create_player(track, volume=settings['volume'], requested_at=requested_at, new_play=True)
+                    start_playback(ctx, player)
+                    state.queue.current = track
+                    
+                    # Update bot status
+                    presence.track_started(guild_id, player.title)
+                    
+                    await asyncio.sleep(1)
+                    if ctx.voice_client.is_playing():
+                        await ctx.send(f"🎵 Now playing: **{player.title}**")
+                    else:
+                        await ctx.send(f"❌ Failed to play: **{player.title}**")
+                    
+            except Exception as e:
+                trace.finish("error", error=e.__class__.__name__)
+                await ctx.send(f"❌ An error occurred: {str(e)}")
+                log.error("Play command error: %s", e, exc_info=True)
 
-@bot.command()
-async def queue(ctx):
-    """Show the current music queue"""
+async def play_playlist(ctx, url):
+    """Queue a whole playlist, starting playback as soon as the first song is listed"""
     guild_id = ctx.guild.id
+    state = get_guild_state(ctx.guild)
+    queue_obj = state.queue
+    await ctx.send("📜 Loading playlist...")
     
-    if guild_id not in music_queues:
-        await ctx.send("📭 The queue is empty!")
+    def add_tracks(tracks):
+        # Batches already on their way when !stop, !clear or !leave cancelled the listing are dropped
+        if task not in state.playlist_tasks:
+            return
+        queue_obj.extend(tracks)
+        state.prefetcher.refresh()
+        
+        voice_client = ctx.voice_client
+        idle = voice_client and not voice_client.is_playing() and not voice_client.is_paused()
+        if idle and queue_obj.current is None and not state.starting:
+            # Batches can arrive back to back, before play_next has set queue.current
+            state.starting = True
+            starter = bot.loop.create_task(play_next(ctx))
+            starter.add_done_callback(lambda _: setattr(state, 'starting', False))
+    
+    task = bot.loop.create_task(ingest_playlist(url, guild_id=guild_id, on_tracks=add_tracks))
+    state.playlist_tasks.add(task)
+    try:
+        title, count = await task
+        await ctx.send(f"➕ Added **{count}** songs from **{title}**")
+    except asyncio.CancelledError:
+        log.info("📜 Stopped listing playlist %s", url)
+    except Exception as e:
+        await ctx.send(f"❌ Failed to load playlist: {str(e)}")
+        log.error("❌ Playlist error: %s", e, exc_info=True)
+    finally:
+        state.playlist_tasks.discard(task)
+
+@bot.command()
+async def playmode(ctx, mode: str = None):
+    """Show or set how songs are played on this server (stream or download)"""
+    settings = get_guild_state(ctx.guild).settings
+    
+    if mode is None:
+        await ctx.send(f"🎚️ Playback mode: **{settings['playback_mode']}**")
         return
     
-    queue_obj = music_queues[guild_id]
+    mode = mode.lower()
+    if mode not in ('stream', 'download'):
+        await ctx.send("❌ Playback mode must be `stream` or `download`!")
+        return
+    
+    settings['playback_mode'] = mode
+    await ctx.send(f"🎚️ Playback mode set to **{mode}**")
+
+@bot.command()
+async def queue(ctx, page: int = 1):
+    """Show the current music queue, 10 songs per page"""
+    state = get_guild_state(ctx.guild)
+    queue_obj = state.queue
     
     if not queue_obj.current and queue_obj.is_empty():
         await ctx.send("📭 The queue is empty!")
@@ -413,23 +1579,84 @@ async def queue(ctx):
     embed = discord.Embed(title="🎵 Music Queue", color=0x00ff9f)
     
     if queue_obj.current:
-        embed.add_field(name="▶️ Now Playing", value=queue_obj.current, inline=False)
+        now_playing_text = queue_obj.current.title
+        position = state.position
+        if position is not None:
+            duration = queue_obj.current.duration
+            total = f" / {format_time(duration)}" if duration else ""
+            now_playing_text += f" `[{format_time(position)}{total}]`"
+        embed.add_field(name="▶️ Now Playing", value=now_playing_text, inline=False)
     
     if not queue_obj.is_empty():
-        queue_list = queue_obj.queue
-        queue_text = "\n".join([f"{i+1}. {song['title']}" for i, song in enumerate(queue_list[:10])])
-        if len(queue_list) > 10:
-            queue_text += f"\n... and {len(queue_list) - 10} more"
+        entries, pages = queue_obj.page(page)
+        queue_text = "\n".join([f"{position}. {track.title}" for position, track in entries])
         embed.add_field(name="⏭️ Up Next", value=queue_text, inline=False)
-        embed.set_footer(text=f"Total in queue: {len(queue_list)}")
+        embed.set_footer(text=f"Total in queue: {len(queue_obj)} • Page {min(max(page, 1), pages)}/{pages}")
     
     await ctx.send(embed=embed)
 
+@bot.command()
+async def remove(ctx, target: str):
+    """Remove a song from the queue by position or video ID"""
+    state = get_guild_state(ctx.guild)
+    queue_obj = state.queue
+    if queue_obj.is_empty():
+        await ctx.send("📭 The queue is empty!")
+        return
+    
+    track = queue_obj.remove(int(target)) if target.isdigit() else queue_obj.remove_id(target)
+    if track is None:
+        await ctx.send(f"❌ No song at `{target}` in the queue!")
+        return
+    
+    state.prefetcher.refresh()
+    await ctx.send(f"🗑️ Removed: **{track.title}**")
+
+@bot.command()
+async def move(ctx, source: int, destination: int):
+    """Move a song to a different position in the queue"""
+    state = get_guild_state(ctx.guild)
+    if state.queue.is_empty():
+        await ctx.send("📭 The queue is empty!")
+        return
+    
+    track = state.queue.move(source, destination)
+    if track is None:
+        await ctx.send(f"❌ No song at position #{source}!")
+        return
+    
+    state.prefetcher.refresh()
+    await ctx.send(f"↕️ Moved **{track.title}** to #{min(max(destination, 1), len(state.queue))}")
+
+@bot.command()
+async def shuffle(ctx):
+    """Shuffle the queue"""
+    state = get_guild_state(ctx.guild)
+    if state.queue.is_empty():
+        await ctx.send("📭 The queue is empty!")
+        return
+    
+    state.queue.shuffle()
+    state.prefetcher.refresh()
+    await ctx.send(f"🔀 Shuffled {len(state.queue)} songs!")
+
+@bot.command()
+async def dedupe(ctx):
+    """Remove repeated songs from the queue"""
+    state = get_guild_state(ctx.guild)
+    if state.queue.is_empty():
+        await ctx.send("📭 The queue is empty!")
+        return
+    
+    removed = state.queue.dedupe()
+    state.prefetcher.refresh()
+    await ctx.send(f"🧹 Removed {removed} repeated song(s)!")
+
 @bot.command()
 async def skip(ctx):
     """Skip the current song"""
     if ctx.voice_client and ctx.voice_client.is_playing():
-        ctx.voice_client.stop()  # This triggers the after callback
+        stop_playback(ctx.voice_client)  # This triggers the after callback
         await ctx.send("⏭️ Skipped!")
     else:
         await ctx.send("❌ Nothing is playing!")
@@ -437,9 +1664,9 @@ async def skip(ctx):
 @bot.command()
 async def clear(ctx):
     """Clear the music queue"""
-    guild_id = ctx.guild.id
-    if guild_id in music_queues:
-        music_queues[guild_id].clear()
+    state = get_guild_state(ctx.guild)
+    if state.queue.current or not state.queue.is_empty():
+        state.clear()
         await ctx.send("🗑️ Queue cleared!")
     else:
         await ctx.send("📭 Queue is already empty!")
@@ -466,11 +1693,13 @@ async def resume(ctx):
 async def stop(ctx):
     """Stop the current song"""
     if ctx.voice_client:
-        ctx.voice_client.stop()
+        stop_playback(ctx.voice_client)
         guild_id = ctx.guild.id
-        if guild_id in music_queues:
-            music_queues[guild_id].clear()
-        await bot.change_presence(activity=discord.Game(name="🎵 Music & AI Chat | !help"))
+        state = get_guild_state(ctx.guild)
+        state.clear()
+        state.resume_point = None
+        ffmpeg_supervisor.kill_guild(guild_id)
+        presence.track_stopped(guild_id)
         await ctx.send("⏹️ Stopped the music!")
     else:
         await ctx.send("❌ Not connected to a voice channel!")
@@ -479,15 +1708,36 @@ async def stop(ctx):
 async def leave(ctx):
     """Leave the voice channel"""
     if ctx.voice_client:
-        guild_id = ctx.guild.id
-        if guild_id in music_queues:
-            music_queues[guild_id].clear()
-        await ctx.voice_client.disconnect()
-        await bot.change_presence(activity=discord.Game(name="🎵 Music & AI Chat | !help"))
+        await disconnect_voice(ctx.voice_client)
         await ctx.send("👋 MikuChan has left the voice channel.")
     else:
         await ctx.send("❌ Not connected to a voice channel!")
 
+@bot.command()
+async def seek(ctx, *, timestamp: str):
+    """Jump to a time in the current song (90, 1:30 or 1:02:03)"""
+    source = ctx.voice_client.source if ctx.voice_client else None
+    if not isinstance(source, TrackSource) or source.stopped:
+        return await ctx.send("❌ Nothing is playing!")
+    
+    position = parse_time(timestamp)
+    if position is None:
+        return await ctx.send("❌ Use a time like `90`, `1:30` or `1:02:03`!")
+    
+    track = source.track
+    if track.duration and position >= track.duration:
+        return await ctx.send(f"❌ **{track.title}** is only {format_time(track.duration)} long!")
+    
+    try:
+        # FFmpeg restarts with -ss against the downloaded file or the stream URL
+        await track.ensure_playable()
+        volume = get_guild_state(ctx.guild).settings['volume']
+        swap_player(ctx, create_player(track, start=position, volume=volume))
+        await ctx.send(f"⏩ Jumped to {format_time(position)}")
+    except Exception as e:
+        await ctx.send(f"❌ Failed to seek: {str(e)}")
+        log.error("❌ Seek error: %s", e, exc_info=True)
+
 @bot.command()
 async def volume(ctx, volume: int):
     """Change the player's volume (0-100)"""
@@ -495,7 +1745,18 @@ async def volume(ctx, volume: int):
         return await ctx.send("❌ Not connected to a voice channel!")
     
     if 0 <= volume <= 100:
-        ctx.voice_client.source.volume = volume / 100
+        get_guild_state(ctx.guild).settings['volume'] = volume / 100
+        source = ctx.voice_client.source
+        if isinstance(source, discord.PCMVolumeTransformer):
+            source.volume = playback_gain(source.track, volume / 100)
+        elif isinstance(source, TrackSource) and not source.stopped:
+            # The gain is baked into FFmpeg's filter, so restart the song from where it is
+            try:
+                await source.track.ensure_playable()
+                swap_player(ctx, create_player(source.track, volume=volume / 100, start=source.position))
+            except Exception as e:
+                log.error("❌ Failed to restart at the new volume: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+                return await ctx.send(f"🔊 Changed volume to {volume}% (takes effect from the next song)")
         await ctx.send(f"🔊 Changed volume to {volume}%")
     else:
         await ctx.send("❌ Volume must be between 0 and 100!")
@@ -508,7 +1769,7 @@ async def volume(ctx, volume: int):
 async def filetest(ctx):
     """Test the most recent downloaded file"""
     try:
-        downloads_dir = 'downloads'
+        downloads_dir = MUSIC_CONFIG["cache_dir"]
         if not os.path.exists(downloads_dir):
             await ctx.send("❌ No downloads folder found!")
             return
@@ -526,17 +1787,17 @@ async def filetest(ctx):
             return
             
         if ctx.voice_client.is_playing():
-            ctx.voice_client.stop()
+            stop_playback(ctx.voice_client)
             
         # Test with the actual file
-        audio_source = discord.FFmpegPCMAudio(abs_path, **ffmpeg_options)
-        ctx.voice_client.play(audio_source, after=lambda e: print(f'File test error: {e}') if e else print('File test completed'))
+        audio_source = SupervisedFFmpegPCMAudio(abs_path, guild_id=ctx.guild.id, **ffmpeg_options)
+        ctx.voice_client.play(audio_source, after=lambda e: log.error("File test error: %s", e) if e else log.info("File test completed"))
         
         await ctx.send(f"🔊 Testing file: {os.path.basename(latest_file)}")
         
     except Exception as e:
         await ctx.send(f"❌ File test failed: {e}")
-        print(f"File test error: {e}")
+        log.error("File test error: %s", e, exc_info=True)
 
 @bot.command()
 async def debug(ctx):
@@ -544,25 +1805,12 @@ async def debug(ctx):
     try:
         info = []
         
-        # Check audio system
-        try:
-            result = subprocess.run(['pactl', 'info'], capture_output=True, text=True)
-            if result.returncode == 0:
-                info.append("✅ PulseAudio is running")
-            else:
-                info.append("❌ PulseAudio not detected")
-        except:
-            info.append("❌ PulseAudio not available")
-            
-        # Check for ALSA
-        try:
-            result = subprocess.run(['aplay', '-l'], capture_output=True, text=True)
-            if result.returncode == 0:
-                info.append("✅ ALSA detected")
-            else:
-                info.append("❌ ALSA not detected")
-        except:
-            info.append("❌ ALSA not available")
+        # Health probes run in the background, so this only reads their latest results
+        health_stats = health.get_stats()
+        info.append(f"🩺 Health: **{health_stats['overall']}**")
+        for name, probe in health_stats['probes'].items():
+            icon = HEALTH_ICONS[probe['status']] if probe['required'] or probe['status'] == OK else "➖"
+            info.append(f"{icon} {name}: {probe['detail']} ({probe['age']:.0f}s ago)")
             
         # Check Discord voice connection
         if ctx.voice_client:
@@ -571,6 +1819,45 @@ async def debug(ctx):
         else:
             info.append("❌ Not connected to voice channel")
             
+        if bot.shard_count:
+            process = f", process {SHARD_PROCESS}" if SHARD_PROCESS is not None else ""
+            info.append(f"🧩 Shard {ctx.guild.shard_id} of {bot.shard_count}{process}")
+        info.append(
+            f"🔌 Voice: {len(bot.voice_clients)} connected, {voice_stats['reconnects']} reconnects "
+            f"({voice_stats['reconnect_failures']} gave up), {voice_stats['reclaimed']} idle connections reclaimed"
+        )
+            
+        # Download cache
+        cache_stats = download_cache.get_stats()
+        info.append(
+            f"💾 Download cache: {cache_stats['files']} songs, "
+            f"{cache_stats['total_bytes'] / 1024**2:.0f}/{cache_stats['max_bytes'] / 1024**2:.0f} MB, "
+            f"{cache_stats['hits']} hits / {cache_stats['misses']} misses"
+        )
+        meta_stats = metadata_cache.get_stats()
+        info.append(
+            f"📇 Metadata cache: {meta_stats['songs']} songs, {meta_stats['searches']} searches, "
+            f"{meta_stats['hit_rate'] * 100:.0f}% hit rate, {meta_stats['refreshes']} URL refreshes"
+        )
+            
+        # FFmpeg processes
+        ffmpeg_stats = ffmpeg_supervisor.get_stats()
+        exit_codes = ", ".join(f"{code}×{count}" for code, count in sorted(ffmpeg_stats['exit_codes'].items())) or "none"
+        info.append(
+            f"🎛️ FFmpeg: {ffmpeg_stats['live']}/{ffmpeg_stats['max_processes']} running, "
+            f"{ffmpeg_stats['spawned']} started ({ffmpeg_stats['rejected']} over limit), "
+            f"spawn p95 {ffmpeg_stats['p95_spawn_time'] * 1000:.0f}ms, "
+            f"{ffmpeg_stats['stragglers_killed'] + ffmpeg_stats['leaks_killed']} stragglers killed, exit codes: {exit_codes}"
+        )
+            
+        # Extraction pool
+        pool_stats = extraction_pool.get_stats()
+        info.append(
+            f"⛏️ Extraction pool: {pool_stats['busy_workers']}/{pool_stats['workers']} busy, "
+            f"{pool_stats['queued_jobs']} queued, "
+            f"wait p95 {pool_stats['p95_wait'] * 1000:.0f}ms / max {pool_stats['max_wait'] * 1000:.0f}ms"
+        )
+            
         # AI system status
         ai_status = "✅ Online" if miku_ai.initialized else "❌ Offline"
         info.append(f"AI Chat System: {ai_status}")
@@ -584,17 +1871,15 @@ async def debug(ctx):
 async def test(ctx):
     """Test if FFmpeg is working"""
     try:
-        # Check if ffmpeg is available
-        result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
-        if result.returncode == 0:
-            await ctx.send("✅ FFmpeg is installed and working!")
-            print("FFmpeg version info:")
-            print(result.stdout[:200])  # First 200 chars
+        # Use the background probe's result, probing now only if it hasn't run yet
+        result = health.get("FFmpeg") or await health.run_probe("FFmpeg")
+        if result.status == OK:
+            await ctx.send(f"✅ FFmpeg is installed and working!\n`{result.detail}`")
+        elif result.status == DEGRADED:
+            await ctx.send(f"⚠️ FFmpeg works but is struggling: {result.detail}")
         else:
-            await ctx.send("❌ FFmpeg is not working properly!")
+            await ctx.send(f"❌ FFmpeg is not working: {result.detail}")
             
-    except FileNotFoundError:
-        await ctx.send("❌ FFmpeg is not installed or not in PATH!")
     except Exception as e:
         await ctx.send(f"❌ Error testing FFmpeg: {e}")
 
@@ -640,15 +1925,21 @@ async def mikuhelp_command(ctx, command_name=None):
     # Music Commands
     music_commands = [
         "**!join** - Join your voice channel",
-        "**!play <song>** - Play music from YouTube",
-        "**!queue** - Show current music queue",
+        "**!play <song>** - Play music from YouTube (songs or playlists)",
+        "**!queue [page]** - Show current music queue",
+        "**!remove <position|id>** - Remove a song from the queue",
+        "**!move <from> <to>** - Move a song in the queue",
+        "**!shuffle** - Shuffle the queue",
+        "**!dedupe** - Remove repeated songs from the queue",
         "**!skip** - Skip current song",
         "**!clear** - Clear the queue",
         "**!pause** - Pause current song",
         "**!resume** - Resume paused song",
+        "**!seek <time>** - Jump to a time in the current song",
         "**!stop** - Stop music and clear queue",
         "**!leave** - Leave voice channel",
-        "**!volume <0-100>** - Change volume"
+        "**!volume <0-100>** - Change volume",
+        "**!playmode [stream|download]** - Show or set how songs are played"
     ]
     embed.add_field(name="🎵 Music", value="\n".join(music_commands), inline=False)
     
@@ -689,10 +1980,7 @@ async def on_command_error(ctx, error):
         await ctx.send("❌ Invalid argument! Use `!help <command>` for usage info.")
     else:
         await ctx.send(f"❌ An error occurred: {str(error)}")
-        if DEBUG_CONFIG["verbose_errors"]:
-            print(f"Command error: {error}")
-            import traceback
-            traceback.print_exc()
+        log.error("❌ Command error: %s", error, exc_info=error if DEBUG_CONFIG["verbose_errors"] else None)
 
 @bot.event
 async def on_message(ctx):
@@ -710,22 +1998,23 @@ async def on_message(ctx):
         message_content = ctx.content.replace(f'<@{bot.user.id}>', '').replace(f'<@!{bot.user.id}>', '').strip()
         
         if message_content and miku_ai.initialized:
-            async with ctx.typing():
-                try:
-                    user_id = str(ctx.author.id)
-                    display_name = ctx.author.display_name
-                    username = ctx.author.name
-                    
-                    response, success = await miku_ai.generate_response(
-                        message_content, user_id, display_name, username
-                    )
-                    
-                    await ctx.reply(response)
-                    
-                except Exception as e:
-                    if DEBUG_CONFIG["verbose_errors"]:
-                        print(f"❌ Mention chat error: {e}")
-                    await ctx.reply("Oops, something went wrong while I was thinking... 🤖✨")
+            burst_key = (ctx.author.id, ctx.channel.id)
+            async with ctx.channel.typing(), chat_bursts.collect(burst_key, ctx, message_content, ctx.reply) as burst:
+                if burst is None:
+                    # Answered together with the user's message just before this one
+                    return
+                
+                guild_id = ctx.guild.id if ctx.guild else None
+                with traced("mention", guild=guild_id, messages=len(burst.messages)) as trace, cancellable_chat(*burst.messages):
+                    try:
+                        success = await answer_chat(ctx, burst)
+                        trace.mark("sent")
+                        trace.finish("ok" if success else "fallback")
+                        
+                    except Exception as e:
+                        trace.finish("error", error=e.__class__.__name__)
+                        chat_log.error("❌ Mention chat error: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+                        await burst.send("Oops, something went wrong while I was thinking... 🤖✨")
 
 # ===================
 # STARTUP
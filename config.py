@@ -111,7 +111,113 @@ CHAT_CONFIG = {
     "rate_limit_window": 60,          # Time window (seconds)
     "temperature": 0.85,              # Randomness in replies (higher = more creative)
     "top_p": 0.95,                    # Token filtering (higher = more options)
-    "max_tokens": 700                 # GPT token usage cap per message
+    "max_tokens": 700,                # GPT token usage cap per message
+    "max_in_flight": 4,               # Model requests running at once, across every server
+    "queue_timeout": 10,              # Seconds a request may wait for a free slot before giving up
+    "request_timeout": 30,            # Seconds before a model request is abandoned
+    "stream_responses": True,         # Post the first sentence right away and edit the rest in
+    "edit_interval": 1.2,             # Minimum seconds between edits of a streamed reply
+    "coalesce_window": 1.5,           # Messages from one user in one channel this close together get one reply
+    "coalesce_max_wait": 6,           # Longest a burst keeps collecting messages before it's answered
+    "response_cache_size": 500,       # Short messages ("hi", "gm") whose replies are kept for reuse
+    "response_cache_ttl": 3600,       # Seconds a cached reply stays usable
+    "response_cache_variants": 3,     # Replies collected per message before cached ones are reused
+    "response_cache_max_length": 40,  # Only messages up to this long (after normalizing) are cached
+    "prefix_member_profiles": False,  # Put every member's profile in the shared prompt prefix
+    "provider_prefix_cache": True,    # Register the prefix as a cached context with Gemini, where supported
+    "prefix_cache_ttl": 3600,         # Seconds Gemini keeps the cached prefix (renewed before it expires)
+    "prefix_cache_model": "models/gemini-1.5-flash-001",  # Cached contexts need a pinned model version
+}
+
+# === Music Configuration ===
+# Playback behavior for the music player.
+
+MUSIC_CONFIG = {
+    "playback_mode": "stream",        # "stream" = start on the stream URL and download in background, "download" = download first
+    "stream_drop_tolerance": 5,       # Seconds short of the full duration before a song ending counts as interrupted
+    "auto_reconnect": True,           # Rejoin after the voice connection drops (not when a moderator removed the bot)
+    "reconnect_audit_window": 30,     # Seconds back the audit log is checked for a moderator disconnecting the bot
+    "reconnect_attempts": 5,          # Rejoin attempts before giving up and clearing the queue
+    "reconnect_backoff": 2,           # Seconds before the first rejoin attempt, doubling after each failure
+    "reconnect_backoff_max": 60,      # Longest wait between rejoin attempts (seconds)
+    "idle_timeout": 600,              # Leave voice after this many seconds with nothing playing
+    "empty_channel_timeout": 60,      # Leave voice this many seconds after the last listener leaves
+    "idle_check_interval": 15,        # How often (seconds) voice connections are checked for idleness
+    "resume_max_attempts": 3,         # Times one song is picked back up after interruptions before moving on
+    "default_volume": 0.5,            # Starting volume for each server (0.0 - 1.0)
+    "volume_mode": "ffmpeg",          # "ffmpeg" = volume and normalization as one FFmpeg filter, "python" = scale PCM per frame
+    "normalize_loudness": True,       # Even out song loudness using a measurement taken once per cached song
+    "loudness_target": -16.0,         # Loudness (LUFS) songs are normalized to
+    "loudness_max_gain": 12.0,        # Most a quiet song is boosted (dB)
+    "opus_passthrough": True,         # Hand Opus sources straight to Discord when the playback gain works out to 1.0
+    "opus_min_bitrate": 96,           # Minimum source bitrate (kbps) for Opus passthrough
+    "extraction_workers": 4,          # yt-dlp worker threads (separate from the AI chat threads)
+    "playlist_max_tracks": 1000,      # Most songs queued from a single playlist
+    "playlist_batch_size": 25,        # Playlist songs added to the queue at a time while listing
+    "prefetch_count": 2,              # Queued songs to download ahead while the current one plays
+    "frame_store": True,              # Pre-encode often replayed songs to Opus frames (no FFmpeg on replay)
+    "frame_store_min_plays": 3,       # Plays of a cached song before its frames are stored
+    "frame_store_bitrate": 128,       # Opus bitrate (kbps) for stored frames
+    "presence_mode": "latest",        # Status while several servers play: "latest" song or "aggregate" server count
+    "presence_debounce": 2,           # Seconds to let status changes settle before sending one update
+    "presence_min_interval": 15,      # Minimum seconds between status updates (the gateway rate limits them)
+    "ffmpeg_max_processes": 64,       # FFmpeg processes allowed at once across all servers
+    "ffmpeg_max_per_guild": 3,        # FFmpeg processes allowed at once for one server
+    "ffmpeg_reap_interval": 30,       # How often (seconds) finished FFmpeg processes are reaped and leaks killed
+    "ffmpeg_stop_grace": 3,           # Seconds a stopped server's FFmpeg gets to exit on its own before it's killed
+    "cache_dir": "downloads",         # Where downloaded songs are cached
+    "cache_max_bytes": 2 * 1024**3,   # Download cache quota (bytes), least recently played songs go first
+    "cache_evict_interval": 300,      # How often (seconds) the cache is trimmed back under quota
+    "cache_index_save_interval": 30,  # Seconds between background download cache index writes
+    "cache_orphan_grace": 3600,       # Age (seconds) before files missing from the cache index are removed
+    "query_ttl": 24 * 3600,           # How long a search keeps resolving to the same song (seconds)
+    "metadata_ttl": 7 * 24 * 3600,    # How long song titles/durations are cached (seconds)
+    "metadata_max_entries": 5000,     # Songs kept in the metadata cache
+    "metadata_save_interval": 30,     # Seconds between background metadata cache writes
+    "stream_url_ttl": 3 * 3600,       # Assumed stream URL lifetime when the URL doesn't say (seconds)
+    "stream_url_margin": 600,         # Refresh stream URLs this many seconds before they expire
+}
+
+# === Health Checks ===
+# Probes run in the background; !debug and !test read their latest results
+
+HEALTH_CONFIG = {
+    "interval": 60,                   # Seconds between most probes
+    "extractor_interval": 600,        # Seconds between extractor probes (these hit YouTube)
+    "ai_interval": 300,               # Seconds between AI backend probes
+    "probe_timeout": 20,              # Seconds before a probe counts as down
+    "min_free_disk": 2 * 1024**3,     # Free disk space (bytes) below which storage counts as degraded
+    "extractor_probe_url": "https://www.youtube.com/watch?v=jNQXAC9IVRw",  # A long-lived video to resolve
+    "extraction_wait_warn": 10,       # p95 extraction queue wait (seconds) that counts as degraded
+}
+
+# === Metrics ===
+# Prometheus endpoint for alerting on latency and error regressions
+
+METRICS_CONFIG = {
+    "enabled": True,                  # Serve metrics over HTTP
+    "host": "127.0.0.1",              # Only reachable from this machine by default
+    "port": 9464,                     # launcher.py processes use port + their process number
+}
+
+# === Logging ===
+# Records are queued and written on a background thread; commands are traced with sampling
+
+LOG_CONFIG = {
+    "level": "INFO",                  # Lowest level written (DEBUG, INFO, WARNING, ERROR)
+    "format": "text",                 # "text" for people, "json" for log collectors
+    "trace_sample_rate": 0.1,         # Share of command traces written to the log
+    "slow_trace_ms": 5000,            # Traces slower than this are always written
+}
+
+# === Sharding ===
+# For large deployments: several gateway connections, optionally split across processes
+
+SHARD_CONFIG = {
+    "enabled": False,                 # Run as an AutoShardedBot (several gateway connections in one process)
+    "shard_count": None,              # Total shards, None = Discord's recommendation
+    "processes": 1,                   # Processes launcher.py splits the shards across
+    "restart_delay": 5,               # Seconds before launcher.py restarts a crashed process (doubles on repeats)
 }
 
 # === Debug Settings ===
@@ -0,0 +1,160 @@
+# extraction.py - yt-dlp worker pool for MikuChan Bot
+
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable
+import yt_dlp
+from metrics import registry
+
+EXTRACTION_SECONDS = registry.histogram("miku_extraction_seconds", "Time yt-dlp jobs spend running on a worker", ["outcome"])
+EXTRACTION_WAIT_SECONDS = registry.histogram("miku_extraction_wait_seconds", "Time yt-dlp jobs wait for a free worker")
+
+# The job a worker thread is running, so yt-dlp's progress hook can see its cancel flag
+_worker_state = threading.local()
+
+def _abort_cancelled_job(progress):
+    job = getattr(_worker_state, 'job', None)
+    if job is not None and job.cancel_event.is_set():
+        raise yt_dlp.utils.DownloadCancelled("Download cancelled")
+
+def current_job_cancelled() -> bool:
+    """For long-running jobs: check from inside the job whether it has been cancelled"""
+    job = getattr(_worker_state, 'job', None)
+    return job is not None and job.cancel_event.is_set()
+
+class ExtractionJob:
+    """A unit of yt-dlp work waiting for (or running on) a worker"""
+    def __init__(self, key: Hashable, fn: Callable, loop: asyncio.AbstractEventLoop):
+        self.key = key
+        self.fn = fn
+        self.loop = loop
+        self.future = loop.create_future()
+        self.cancel_event = threading.Event()
+        self.enqueued_at = time.perf_counter()
+
+class ExtractionPool:
+    """Bounded pool of yt-dlp workers, each with its own YoutubeDL, shared fairly between servers.
+
+    Jobs are queued per key (the server ID) and workers take one job from each key in turn,
+    so a server queueing a whole playlist can't starve everyone else.
+    """
+
+    def __init__(self, options: Dict, workers: int, ydl_class: Callable = yt_dlp.YoutubeDL):
+        self.options = options
+        self.workers = workers
+        self.ydl_class = ydl_class
+        self._pending: Dict[Hashable, Deque[ExtractionJob]] = {}
+        self._order: Deque[Hashable] = deque()
+        self._cond = threading.Condition()
+        self._threads = []
+
+        # Queue-wait metrics
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+        self.busy_workers = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=200)
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name=f"ytdl-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    async def run(self, key: Hashable, fn: Callable):
+        """Run fn(ydl) on a worker and return its result. Cancelling also aborts a running download."""
+        job = ExtractionJob(key, fn, asyncio.get_running_loop())
+
+        with self._cond:
+            if key not in self._pending:
+                self._pending[key] = deque()
+                self._order.append(key)
+            self._pending[key].append(job)
+            self._cond.notify()
+
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            job.cancel_event.set()
+            raise
+
+    def _next_job(self) -> ExtractionJob:
+        """Take the next job, rotating between keys"""
+        with self._cond:
+            while not self._order:
+                self._cond.wait()
+
+            key = self._order.popleft()
+            jobs = self._pending[key]
+            job = jobs.popleft()
+            if jobs:
+                self._order.append(key)
+            else:
+                del self._pending[key]
+            return job
+
+    def _worker(self):
+        ydl = self.ydl_class(self.options)
+        ydl.add_progress_hook(_abort_cancelled_job)
+
+        while True:
+            job = self._next_job()
+            if job.future.cancelled():
+                continue
+
+            wait = time.perf_counter() - job.enqueued_at
+            with self._cond:
+                self.busy_workers += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.recent_waits.append(wait)
+            EXTRACTION_WAIT_SECONDS.observe(wait)
+
+            _worker_state.job = job
+            started = time.perf_counter()
+            try:
+                result = job.fn(ydl)
+            except Exception as e:
+                EXTRACTION_SECONDS.observe(time.perf_counter() - started, outcome="error")
+                with self._cond:
+                    self.jobs_failed += 1
+                job.loop.call_soon_threadsafe(self._resolve, job.future, None, e)
+            else:
+                EXTRACTION_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+                with self._cond:
+                    self.jobs_completed += 1
+                job.loop.call_soon_threadsafe(self._resolve, job.future, result, None)
+            finally:
+                _worker_state.job = None
+                with self._cond:
+                    self.busy_workers -= 1
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def get_stats(self) -> Dict:
+        """Get pool and queue-wait statistics"""
+        with self._cond:
+            waits = sorted(self.recent_waits)
+            queued = {key: len(jobs) for key, jobs in self._pending.items()}
+            jobs_started = self.jobs_completed + self.jobs_failed + self.busy_workers
+
+        return {
+            "workers": self.workers,
+            "busy_workers": self.busy_workers,
+            "queued_jobs": sum(queued.values()),
+            "queued_by_key": queued,
+            "jobs_completed": self.jobs_completed,
+            "jobs_failed": self.jobs_failed,
+            "avg_wait": self.total_wait / jobs_started if jobs_started else 0.0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "max_wait": self.max_wait,
+        }
@@ -0,0 +1,196 @@
+# ffmpeg_supervisor.py - Central ownership of FFmpeg child processes for MikuChan Bot
+
+import asyncio
+import logging
+import subprocess
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from typing import Deque, Dict, Hashable, Optional, Set
+from config import MUSIC_CONFIG, DEBUG_CONFIG
+from metrics import registry
+
+log = logging.getLogger("miku.ffmpeg")
+
+FFMPEG_SPAWN_SECONDS = registry.histogram(
+    "miku_ffmpeg_spawn_seconds", "Time to start an FFmpeg process", ["kind"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+FFMPEG_REJECTED = registry.counter("miku_ffmpeg_rejected_total", "FFmpeg starts refused by a process limit")
+FFMPEG_KILLED = registry.counter("miku_ffmpeg_killed_total", "FFmpeg processes the supervisor had to kill", ["reason"])
+FFMPEG_LIVE = registry.gauge("miku_ffmpeg_live_processes", "FFmpeg processes currently running")
+
+class FFmpegLimitReached(RuntimeError):
+    """Raised when starting another FFmpeg process would go over a concurrency limit"""
+
+class SupervisedProcess:
+    """A tracked FFmpeg process and who it belongs to"""
+    def __init__(self, process: subprocess.Popen, guild_id: Optional[Hashable], kind: str, owner=None):
+        self.process = process
+        self.guild_id = guild_id
+        self.kind = kind
+        self.owner = weakref.ref(owner) if owner is not None else None
+        self.started = time.monotonic()
+        self.killed = False
+
+    def owner_gone(self) -> bool:
+        return self.owner is not None and self.owner() is None
+
+class FFmpegSupervisor:
+    """Owns every FFmpeg process the bot starts.
+
+    Processes are capped globally and per server, finished ones are reaped (their exit codes
+    recorded), and anything still running for a server that stopped, or whose player was
+    dropped without cleanup, is killed. Killed processes stay tracked until they're reaped, so
+    nothing here waits for a process to exit.
+    """
+
+    def __init__(self, max_processes: int = None, max_per_guild: int = None):
+        self.max_processes = max_processes or MUSIC_CONFIG["ffmpeg_max_processes"]
+        self.max_per_guild = max_per_guild or MUSIC_CONFIG["ffmpeg_max_per_guild"]
+        self.processes: Dict[subprocess.Popen, SupervisedProcess] = {}
+        self.reaper_task = None
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.spawned = 0
+        self.rejected = 0
+        self.stragglers_killed = 0
+        self.leaks_killed = 0
+        self.exit_codes: Counter = Counter()
+        self.spawn_times: Deque[float] = deque(maxlen=200)
+        self.max_spawn_time = 0.0
+        FFMPEG_LIVE.set_function(lambda: len(self.processes))
+
+    def _live_count(self, guild_id: Optional[Hashable] = None) -> int:
+        if guild_id is None:
+            return len(self.processes)
+        return sum(1 for entry in self.processes.values() if entry.guild_id == guild_id)
+
+    def _check_limits(self, guild_id: Optional[Hashable]) -> Optional[str]:
+        """Say which limit a new process would break, if any (call with the lock held)"""
+        if len(self.processes) >= self.max_processes:
+            return f"{self.max_processes} FFmpeg processes are already running"
+        if guild_id is not None and self._live_count(guild_id) >= self.max_per_guild:
+            return f"this server already has {self.max_per_guild} FFmpeg processes running"
+        return None
+
+    def spawn(self, args, *, guild_id: Optional[Hashable] = None, kind: str = "playback",
+              owner=None, wait: bool = False, **popen_kwargs) -> subprocess.Popen:
+        """Start an FFmpeg process under supervision.
+
+        Over a limit this raises FFmpegLimitReached, or with wait=True (for background work
+        running off the event loop) blocks until a slot frees up.
+        """
+        while True:
+            with self._lock:
+                self._reap_locked()
+                problem = self._check_limits(guild_id)
+                if problem is None:
+                    start = time.perf_counter()
+                    process = subprocess.Popen(args, **popen_kwargs)
+                    elapsed = time.perf_counter() - start
+
+                    self.processes[process] = SupervisedProcess(process, guild_id, kind, owner)
+                    self.spawned += 1
+                    self.spawn_times.append(elapsed)
+                    self.max_spawn_time = max(self.max_spawn_time, elapsed)
+                    FFMPEG_SPAWN_SECONDS.observe(elapsed, kind=kind)
+                    return process
+                if not wait:
+                    self.rejected += 1
+                    FFMPEG_REJECTED.inc()
+                    raise FFmpegLimitReached(f"Can't start FFmpeg: {problem}")
+            time.sleep(0.5)
+
+    def release(self, process: subprocess.Popen):
+        """Stop tracking a process its owner has killed and waited for"""
+        with self._lock:
+            entry = self.processes.pop(process, None)
+            if entry is not None and process.returncode is not None:
+                self.exit_codes[process.returncode] += 1
+
+    def _reap_locked(self):
+        """Forget processes that have exited and kill ones whose owner was dropped without cleanup"""
+        for process, entry in list(self.processes.items()):
+            if process.poll() is not None:
+                del self.processes[process]
+                self.exit_codes[entry.process.returncode] += 1
+            elif entry.owner_gone() and not entry.killed:
+                self._kill(entry)
+                self.leaks_killed += 1
+                FFMPEG_KILLED.inc(reason="leak")
+
+    def reap(self):
+        """Reap finished processes and kill leaked ones"""
+        with self._lock:
+            self._reap_locked()
+
+    @staticmethod
+    def _kill(entry: SupervisedProcess):
+        """Send the kill signal. The process is left for _reap_locked to collect once it exits."""
+        entry.killed = True
+        try:
+            entry.process.kill()
+        except Exception as e:
+            log.warning("⚠️ Failed to kill FFmpeg process %s: %s", entry.process.pid, e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+    def kill_guild(self, guild_id: Hashable, grace: float = None):
+        """Kill the FFmpeg processes a server has running now if they outlive a grace period.
+
+        Called when a server stops or leaves: its player cleans up its own process first, and
+        only what's left after MUSIC_CONFIG["ffmpeg_stop_grace"] counts as a straggler. Processes
+        started in the meantime (the next !play) aren't touched.
+        """
+        with self._lock:
+            running = {process for process, entry in self.processes.items() if entry.guild_id == guild_id}
+        if running:
+            grace = MUSIC_CONFIG["ffmpeg_stop_grace"] if grace is None else grace
+            asyncio.get_running_loop().call_later(grace, self._kill_stragglers, guild_id, running)
+
+    def _kill_stragglers(self, guild_id: Hashable, processes: Set[subprocess.Popen]) -> int:
+        """Kill those of the given processes that are still running. Returns how many were killed."""
+        with self._lock:
+            stragglers = [
+                entry for process, entry in self.processes.items()
+                if process in processes and not entry.killed and process.poll() is None
+            ]
+            for entry in stragglers:
+                self._kill(entry)
+            self.stragglers_killed += len(stragglers)
+            FFMPEG_KILLED.inc(len(stragglers), reason="straggler")
+        if stragglers:
+            log.warning("🔪 Killed %d leftover FFmpeg process(es) for guild %s", len(stragglers), guild_id)
+        return len(stragglers)
+
+    async def _reaper_loop(self):
+        while True:
+            await asyncio.sleep(MUSIC_CONFIG["ffmpeg_reap_interval"])
+            self.reap()
+
+    def start_reaper(self):
+        """Start the background reaper if it isn't running yet"""
+        if self.reaper_task is None or self.reaper_task.done():
+            self.reaper_task = asyncio.get_running_loop().create_task(self._reaper_loop())
+
+    def get_stats(self) -> Dict:
+        """Get process statistics"""
+        with self._lock:
+            times = sorted(self.spawn_times)
+            by_kind = Counter(entry.kind for entry in self.processes.values())
+            live = len(self.processes)
+
+        return {
+            "live": live,
+            "live_by_kind": dict(by_kind),
+            "max_processes": self.max_processes,
+            "spawned": self.spawned,
+            "rejected": self.rejected,
+            "stragglers_killed": self.stragglers_killed,
+            "leaks_killed": self.leaks_killed,
+            "exit_codes": dict(self.exit_codes),
+            "avg_spawn_time": sum(times) / len(times) if times else 0.0,
+            "p95_spawn_time": times[int(len(times) * 0.95)] if times else 0.0,
+            "max_spawn_time": self.max_spawn_time,
+        }
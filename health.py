@@ -0,0 +1,164 @@
+# health.py - Background health probes for MikuChan Bot
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from config import HEALTH_CONFIG, DEBUG_CONFIG
+
+log = logging.getLogger("miku.health")
+
+OK = "ok"
+DEGRADED = "degraded"
+DOWN = "down"
+
+# A probe returns (status, detail)
+Probe = Callable[[], Awaitable[Tuple[str, str]]]
+
+class ProbeResult:
+    """The latest outcome of one probe"""
+    def __init__(self, status: str, detail: str, duration: float):
+        self.status = status
+        self.detail = detail
+        self.duration = duration
+        self.checked_at = time.time()
+
+class HealthMonitor:
+    """Runs health probes in the background on a schedule and keeps their latest results.
+
+    Commands read the cached results, so they never wait on a subprocess or the network,
+    and components going down are logged as soon as a probe notices.
+    """
+
+    def __init__(self):
+        self.probes: Dict[str, Tuple[Probe, float, bool]] = {}
+        self.results: Dict[str, ProbeResult] = {}
+        self.tasks: List[asyncio.Task] = []
+
+    def register(self, name: str, probe: Probe, *, interval: float = None, required: bool = True):
+        """Add a probe. Optional probes are shown but don't make the bot count as degraded."""
+        self.probes[name] = (probe, interval or HEALTH_CONFIG["interval"], required)
+
+    async def run_probe(self, name: str) -> ProbeResult:
+        """Run one probe now and store its result"""
+        probe, _, _ = self.probes[name]
+        start = time.perf_counter()
+        try:
+            status, detail = await asyncio.wait_for(probe(), HEALTH_CONFIG["probe_timeout"])
+        except asyncio.TimeoutError:
+            status, detail = DOWN, f"no answer within {HEALTH_CONFIG['probe_timeout']}s"
+        except Exception as e:
+            status, detail = DOWN, str(e) or e.__class__.__name__
+        result = ProbeResult(status, detail, time.perf_counter() - start)
+
+        previous = self.results.get(name)
+        self.results[name] = result
+        if previous is None or previous.status != status:
+            if status != OK:
+                log.warning("⚠️ Health: %s is %s: %s", name, status, detail)
+            elif previous is not None:
+                log.info("✅ Health: %s recovered", name)
+        return result
+
+    async def _probe_loop(self, name: str, interval: float):
+        while True:
+            try:
+                await self.run_probe(name)
+            except Exception as e:
+                log.warning("⚠️ Health probe %s crashed: %s", name, e, exc_info=DEBUG_CONFIG["verbose_errors"])
+            await asyncio.sleep(interval)
+
+    def start(self):
+        """Start probing in the background if it isn't running yet"""
+        if self.tasks and not all(task.done() for task in self.tasks):
+            return
+        loop = asyncio.get_running_loop()
+        self.tasks = [
+            loop.create_task(self._probe_loop(name, interval))
+            for name, (_, interval, _) in self.probes.items()
+        ]
+
+    def get(self, name: str) -> Optional[ProbeResult]:
+        return self.results.get(name)
+
+    def overall(self) -> str:
+        """Worst status among the required probes that have run"""
+        statuses = [
+            self.results[name].status for name, (_, _, required) in self.probes.items()
+            if required and name in self.results
+        ]
+        if DOWN in statuses:
+            return DOWN
+        if DEGRADED in statuses:
+            return DEGRADED
+        return OK
+
+    def get_stats(self) -> Dict:
+        """Get every probe's latest result"""
+        return {
+            "overall": self.overall(),
+            "probes": {
+                name: {
+                    "status": result.status,
+                    "detail": result.detail,
+                    "age": time.time() - result.checked_at,
+                    "duration": result.duration,
+                    "required": self.probes[name][2],
+                }
+                for name, result in self.results.items()
+            },
+        }
+
+# ===================
+# PROBES
+# ===================
+
+def command_probe(args: List[str], *, parse: Callable[[str], str] = None) -> Probe:
+    """Probe that a command runs and exits cleanly, without blocking the event loop"""
+    async def probe():
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            return DOWN, f"{args[0]} is not installed or not in PATH"
+        try:
+            stdout, _ = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            return DOWN, f"{args[0]} exited with code {process.returncode}"
+        output = stdout.decode('utf-8', errors='replace')
+        return OK, parse(output) if parse else "working"
+    return probe
+
+def first_line(output: str) -> str:
+    lines = output.strip().splitlines()
+    return lines[0][:100] if lines else "working"
+
+def directory_probe(path: str) -> Probe:
+    """Probe that a directory exists and can be written to"""
+    async def probe():
+        def check():
+            os.makedirs(path, exist_ok=True)
+            test_file = os.path.join(path, ".health")
+            with open(test_file, 'w') as f:
+                f.write("ok")
+            os.remove(test_file)
+        await asyncio.get_running_loop().run_in_executor(None, check)
+        return OK, f"{path} is writable"
+    return probe
+
+def disk_space_probe(path: str, min_free_bytes: int) -> Probe:
+    """Probe that the disk holding a directory has room left"""
+    async def probe():
+        usage = await asyncio.get_running_loop().run_in_executor(None, shutil.disk_usage, path)
+        free_gb = usage.free / 1024**3
+        if usage.free < min_free_bytes:
+            return DEGRADED, f"only {free_gb:.1f} GB free"
+        return OK, f"{free_gb:.1f} GB free"
+    return probe
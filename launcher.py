@@ -0,0 +1,155 @@
+# launcher.py - Runs MikuChan's shards across several processes on one host
+#
+# Usage: python launcher.py [--processes 4] [--shards 16]
+#
+# Each process runs bot.py as an AutoShardedBot for its own slice of the shards, so the bot
+# isn't limited to one gateway connection or one GIL. Processes share no live state: each keeps its
+# own music state, download cache (downloads/process-N) and chat history file, which each process
+# merges from all of them when it starts. A process that crashes is restarted
+# on its own without touching the others.
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from dotenv import load_dotenv
+from config import SHARD_CONFIG
+
+# Discord allows one identify per 5 seconds per concurrency bucket
+IDENTIFY_INTERVAL = 5
+
+def fetch_gateway_info(token):
+    """Ask Discord how many shards it recommends and how many may identify at once"""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={'Authorization': f"Bot {token}", 'User-Agent': "MikuChan launcher"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        data = json.load(response)
+    return data['shards'], data.get('session_start_limit', {}).get('max_concurrency', 1)
+
+def split_shards(shard_count, processes):
+    """Split shard IDs into contiguous, evenly sized slices, one per process"""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    slices, start = [], 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(list(range(start, end)))
+        start = end
+    return slices
+
+class ShardProcess:
+    """One bot.py process and the shards it runs"""
+
+    def __init__(self, index, shard_ids, shard_count):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.restart_delay = SHARD_CONFIG["restart_delay"]
+        self.restart_at = None
+
+    def start(self):
+        env = {
+            **os.environ,
+            'SHARD_IDS': ",".join(str(shard_id) for shard_id in self.shard_ids),
+            'SHARD_COUNT': str(self.shard_count),
+            'SHARD_PROCESS': str(self.index),
+        }
+        bot_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+        self.process = subprocess.Popen([sys.executable, bot_file], env=env)
+        self.started_at = time.monotonic()
+        print(f"🧩 Process {self.index} started (pid {self.process.pid}) with shards {self.shard_ids}")
+
+    def check(self):
+        """Restart the process if it died, backing off if it keeps dying"""
+        if self.process is not None and self.process.poll() is None:
+            return
+        now = time.monotonic()
+        if self.process is not None:
+            code = self.process.returncode
+            self.process = None
+            # A process that ran for a while gets the short delay again
+            if now - self.started_at > 10 * SHARD_CONFIG["restart_delay"]:
+                self.restart_delay = SHARD_CONFIG["restart_delay"]
+            print(f"⚠️ Process {self.index} exited with code {code}, restarting in {self.restart_delay}s")
+            self.restart_at = now + self.restart_delay
+            self.restart_delay = min(self.restart_delay * 2, 300)
+        if self.restart_at is not None and now >= self.restart_at:
+            self.restart_at = None
+            self.start()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait(self, timeout):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run MikuChan's shards across several processes")
+    parser.add_argument('--processes', type=int, default=SHARD_CONFIG["processes"], help="Processes to run")
+    parser.add_argument('--shards', type=int, default=SHARD_CONFIG["shard_count"], help="Total shards (default: Discord's recommendation)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    token = os.getenv('DISCORD_TOKEN')
+    if not token:
+        print("❌ Error: DISCORD_TOKEN not found in .env file!")
+        sys.exit(1)
+
+    shard_count, max_concurrency = args.shards, 1
+    try:
+        recommended, max_concurrency = fetch_gateway_info(token)
+        shard_count = shard_count or recommended
+    except Exception as e:
+        if not shard_count:
+            print(f"❌ Couldn't get the recommended shard count ({e}), pass --shards")
+            sys.exit(1)
+        print(f"⚠️ Couldn't get gateway info ({e}), starting processes one identify window apart")
+
+    processes = [
+        ShardProcess(index, shard_ids, shard_count)
+        for index, shard_ids in enumerate(split_shards(shard_count, args.processes))
+    ]
+    print(f"🚀 Running {shard_count} shards across {len(processes)} processes")
+
+    stopping = False
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    try:
+        for shard_process in processes:
+            if stopping:
+                break
+            shard_process.start()
+            # Processes don't coordinate identifies, so give each one time to log in its shards
+            windows = -(-len(shard_process.shard_ids) // max_concurrency)
+            time.sleep(windows * IDENTIFY_INTERVAL)
+
+        while not stopping:
+            for shard_process in processes:
+                shard_process.check()
+            time.sleep(1)
+    finally:
+        print("🛑 Stopping shard processes...")
+        for shard_process in processes:
+            shard_process.stop()
+        for shard_process in processes:
+            shard_process.wait(timeout=15)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+# logs.py - Queued structured logging and request tracing for MikuChan Bot
+
+import asyncio
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from config import LOG_CONFIG, DEBUG_CONFIG
+from metrics import registry
+
+TRACE_STAGE_SECONDS = registry.histogram(
+    "miku_trace_stage_seconds", "Time from a command arriving to each stage of handling it", ["trace", "stage"]
+)
+
+trace_log = logging.getLogger("miku.trace")
+
+class StructuredFormatter(logging.Formatter):
+    """Formats a record's message plus any fields passed as extra={'fields': {...}}.
+
+    "text" puts the fields after the message as key=value pairs, "json" writes one object per line.
+    """
+
+    def __init__(self, style: str = "text"):
+        super().__init__()
+        self.style = style
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, 'fields', None) or {}
+        message = record.getMessage()
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+
+        if self.style == "json":
+            entry = {
+                "time": f"{timestamp}.{int(record.msecs):03d}",
+                "level": record.levelname,
+                "logger": record.name,
+                "message": message,
+                **fields,
+            }
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        line = f"{timestamp} {record.levelname:<7} {record.name}: {message}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class _ConsoleHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is when the record is written, like print does"""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_setup_lock = threading.Lock()
+
+def setup_logging():
+    """Send the bot's log records through a queue to a background thread that formats and writes them.
+
+    Logging from the event loop then only costs a queue put. DEBUG_CONFIG's flags become logger
+    levels here, once, instead of being checked on every call.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        console = _ConsoleHandler()
+        console.setFormatter(StructuredFormatter(LOG_CONFIG["format"]))
+        records = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(records, console, respect_handler_level=True)
+
+        root = logging.getLogger("miku")
+        root.setLevel(LOG_CONFIG["level"])
+        root.addHandler(logging.handlers.QueueHandler(records))
+        root.propagate = False
+
+        quiet = logging.WARNING
+        logging.getLogger("miku.ai").setLevel(logging.INFO if DEBUG_CONFIG["log_ai_requests"] else quiet)
+        logging.getLogger("miku.chat").setLevel(logging.INFO if DEBUG_CONFIG["log_ai_requests"] else quiet)
+        logging.getLogger("miku.ai.context").setLevel(logging.INFO if DEBUG_CONFIG["log_personality_context"] else quiet)
+        logging.getLogger("miku.ai.ratelimit").setLevel(logging.INFO if DEBUG_CONFIG["log_rate_limits"] else quiet)
+
+        _listener.start()
+        atexit.register(stop_logging)
+
+def stop_logging():
+    """Write out anything still queued"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+# ===================
+# TRACING
+# ===================
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """Timings for one command, from arriving to its last stage (first audio frame, reply sent...).
+
+    Every trace feeds the stage histogram. Only a sample of them, plus any slower than
+    LOG_CONFIG["slow_trace_ms"], is written to the log.
+    """
+
+    def __init__(self, name: str, fields: Dict):
+        self.name = name
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self.sampled = random.random() < LOG_CONFIG["trace_sample_rate"]
+        self.handed_off = False
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def mark(self, stage: str):
+        """Record that a stage was reached"""
+        with self._lock:
+            if self.finished:
+                return
+            elapsed = time.perf_counter() - self.started
+            self.stages.append((stage, elapsed))
+        TRACE_STAGE_SECONDS.observe(elapsed, trace=self.name, stage=stage)
+
+    def hand_off(self):
+        """Let something that outlives the command (e.g. the player) finish the trace"""
+        self.handed_off = True
+
+    def finish(self, outcome: str = "ok", **fields):
+        """End the trace and log it if it was sampled or slow. Later calls do nothing."""
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            total = time.perf_counter() - self.started
+        TRACE_STAGE_SECONDS.observe(total, trace=self.name, stage="total")
+
+        total_ms = total * 1000
+        if not (self.sampled or total_ms >= LOG_CONFIG["slow_trace_ms"]):
+            return
+        fields = {
+            **self.fields,
+            **fields,
+            "outcome": outcome,
+            "total_ms": round(total_ms),
+            **{f"{stage}_ms": round(elapsed * 1000) for stage, elapsed in self.stages},
+        }
+        trace_log.info("⏱️ %s", self.name, extra={'fields': fields})
+
+def current_trace() -> Optional[Trace]:
+    """The trace of the command this code is running for, if any"""
+    return _current_trace.get()
+
+def trace_mark(stage: str):
+    """Mark a stage on the current command's trace, if there is one"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.mark(stage)
+
+@contextmanager
+def traced(name: str, **fields):
+    """Trace a command. Code it calls (and tasks it starts) can mark stages with trace_mark().
+
+    The trace finishes when the block ends unless it was handed off, and failures are recorded.
+    """
+    trace = Trace(name, fields)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except asyncio.CancelledError:
+        trace.finish("cancelled")
+        raise
+    except BaseException as e:
+        trace.finish("error", error=e.__class__.__name__)
+        raise
+    finally:
+        _current_trace.reset(token)
+        if not trace.handed_off:
+            trace.finish()
@@ -0,0 +1,251 @@
+# metrics.py - Metrics registry and Prometheus endpoint for MikuChan Bot
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+from aiohttp import web
+from config import METRICS_CONFIG, DEBUG_CONFIG
+
+log = logging.getLogger("miku.metrics")
+
+# Latency buckets (seconds) covering a fast cache hit up to a slow extraction
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric:
+    """A named metric with optional labels. Updates are thread-safe."""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _label_text(self, key: Tuple[str, ...], extra: Dict = None) -> str:
+        pairs = list(zip(self.label_names, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    """A count that only goes up"""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        with self._lock:
+            return sum(self._values.values())
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{self._label_text(key)} {_format_number(value)}" for key, value in values.items()]
+
+class Gauge(Metric):
+    """A value that goes up and down, either set directly or read from a function when scraped"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Callable = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable):
+        """Read the value at scrape time. With labels the function returns {label tuple: value}."""
+        self._function = function
+
+    def _current(self) -> Dict[Tuple[str, ...], float]:
+        if self._function is None:
+            with self._lock:
+                return dict(self._values)
+        value = self._function()
+        if not self.label_names:
+            return {(): value}
+        return {tuple(str(part) for part in key): amount for key, amount in value.items()}
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{self._label_text(key)} {_format_number(value)}" for key, value in self._current().items()]
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, plus their sum and count"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # label tuple -> [per-bucket counts, sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with-block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _merged(self) -> Tuple[List[int], float, int]:
+        """Bucket counts, sum and count across every label set"""
+        counts, total, count = [0] * len(self.buckets), 0.0, 0
+        with self._lock:
+            for series_counts, series_sum, series_count in self._series.values():
+                counts = [a + b for a, b in zip(counts, series_counts)]
+                total += series_sum
+                count += series_count
+        return counts, total, count
+
+    def summary(self) -> Dict:
+        """Count, average and estimated p50/p95 across every label set"""
+        counts, total, count = self._merged()
+        return {
+            "count": count,
+            "avg": total / count if count else 0.0,
+            "p50": self._quantile(counts, count, 0.50),
+            "p95": self._quantile(counts, count, 0.95),
+        }
+
+    def _quantile(self, counts: List[int], count: int, q: float) -> float:
+        """Estimate a quantile by interpolating inside its bucket, like Prometheus' histogram_quantile"""
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                upper = self.buckets[index]
+                lower = self.buckets[index - 1] if index else 0.0
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-2]
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        lines = []
+        for key, (counts, total, count) in series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self._label_text(key, {'le': _format_number(bound)})} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {_format_number(total)}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Every metric the bot keeps, rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name: str, *args, **kwargs) -> Metric:
+        with self._lock:
+            # Asking for an existing metric returns it, so modules can be imported more than once
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                log.warning("⚠️ Failed to render metric %s: %s", metric.name, e, exc_info=DEBUG_CONFIG["verbose_errors"])
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+class MetricsServer:
+    """Serves the registry at /metrics on a local HTTP port for Prometheus to scrape"""
+
+    def __init__(self, metrics: MetricsRegistry = registry, host: str = None, port: int = None):
+        self.registry = metrics
+        self.host = host or METRICS_CONFIG["host"]
+        self.port = port or METRICS_CONFIG["port"]
+        self.runner = None
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={'X-Content-Type-Options': "nosniff"})
+
+    async def start(self):
+        """Start serving if it isn't running yet"""
+        if self.runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, self.host, self.port).start()
+        except OSError as e:
+            await self.runner.cleanup()
+            self.runner = None
+            log.error("❌ Couldn't serve metrics on %s:%s: %s", self.host, self.port, e)
+            return
+        log.info("📈 Serving metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,440 @@
+# music_cache.py - Download and metadata caches for MikuChan Bot
+
+import asyncio
+import glob
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, Optional
+from urllib.parse import parse_qs, urlparse
+from config import MUSIC_CONFIG, DEBUG_CONFIG
+
+log = logging.getLogger("miku.cache")
+
+# Fields kept from yt-dlp's info dict so a cached song can play without extraction
+CACHED_INFO_FIELDS = (
+    'id', 'title', 'duration', 'extractor_key', 'webpage_url', 'ext', 'acodec', 'abr',
+)
+
+LOUDNORM_JSON = re.compile(r'\{[^{}]*"input_i"[^{}]*\}')
+
+def measure_loudness(path: str, executable: str = 'ffmpeg', spawn: Callable = subprocess.Popen) -> float:
+    """Measure a file's integrated loudness (LUFS) with FFmpeg's loudnorm filter.
+
+    spawn starts the FFmpeg process (e.g. through a supervisor); it takes Popen's arguments.
+    """
+    args = [
+        executable, '-nostdin', '-hide_banner', '-nostats', '-i', path, '-vn',
+        '-af', 'loudnorm=print_format=json', '-f', 'null', '-',
+    ]
+    process = spawn(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"FFmpeg exited with code {process.returncode} while analysing {path}")
+
+    match = LOUDNORM_JSON.search(stderr.decode('utf-8', errors='replace'))
+    if not match:
+        raise RuntimeError(f"No loudness measurement in FFmpeg output for {path}")
+    loudness = float(json.loads(match.group(0))["input_i"])
+    if loudness == float('-inf'):
+        raise RuntimeError(f"{path} is silent")
+    return loudness
+
+class DownloadCache:
+    """Size-bounded download cache keyed by extractor + video ID, evicted least recently used first"""
+
+    def __init__(self, directory: str = None, max_bytes: int = None):
+        self.directory = directory or MUSIC_CONFIG["cache_dir"]
+        self.max_bytes = max_bytes or MUSIC_CONFIG["cache_max_bytes"]
+        self.index_file = os.path.join(self.directory, "index.json")
+        self.entries: Dict[str, Dict] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.eviction_task = None
+        self.autosave_task = None
+        self._pinned: Dict[str, int] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        # Held for a whole index write, so the eviction thread and the autosave loop never share the tmp file
+        self._write_lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(extractor_key: str, video_id: str) -> str:
+        """Build the cache key for a video (matches the yt-dlp output template)"""
+        return f"{extractor_key}-{video_id}"
+
+    def key_for(self, data: Dict) -> Optional[str]:
+        """Get the cache key for a yt-dlp info dict"""
+        if not data.get('extractor_key') or not data.get('id'):
+            return None
+        return self.make_key(data['extractor_key'], data['id'])
+
+    def _load_index(self):
+        """Load the index from disk, dropping entries whose files are gone"""
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.entries = {key: entry for key, entry in data.items() if os.path.exists(entry["file"])}
+                log.info("💾 Loaded download cache index with %d songs", len(self.entries))
+        except Exception as e:
+            log.warning("⚠️ Failed to load download cache index: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+    def save_index(self):
+        """Write the index to disk atomically. Blocks on file I/O, so keep it off the event loop."""
+        with self._write_lock:
+            with self._lock:
+                # Entries are updated in place (last_used, plays, frames), so copy them for the dump
+                snapshot = {
+                    key: {**entry, "frames": dict(entry["frames"])} if "frames" in entry else dict(entry)
+                    for key, entry in self.entries.items()
+                }
+                self._dirty = False
+            try:
+                tmp_file = self.index_file + ".tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f, indent=2, ensure_ascii=False)
+                os.replace(tmp_file, self.index_file)
+            except Exception as e:
+                self._dirty = True
+                log.warning("⚠️ Failed to save download cache index: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+    async def _autosave_loop(self, interval: int):
+        """Write index changes in the background, off the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            if self._dirty:
+                await loop.run_in_executor(None, self.save_index)
+
+    def start_autosave(self):
+        """Start the background index writer if it isn't running yet"""
+        if self.autosave_task is None or self.autosave_task.done():
+            self.autosave_task = asyncio.get_running_loop().create_task(
+                self._autosave_loop(MUSIC_CONFIG["cache_index_save_interval"])
+            )
+
+    def lookup(self, key: str) -> Optional[Dict]:
+        """Get the cache entry for a key, counting the hit or miss"""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and not os.path.exists(entry["file"]):
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entry["last_used"] = time.time()
+            self._dirty = True
+            return entry
+
+    def record_play(self, key: str) -> int:
+        """Count a play of a cached song and return its total plays"""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return 0
+            entry["plays"] = entry.get("plays", 0) + 1
+            self._dirty = True
+            return entry["plays"]
+
+    def frames_for(self, key: str, volume_key: str) -> Optional[str]:
+        """Get the pre-encoded Opus frame file for a song at a volume, if one was built"""
+        with self._lock:
+            entry = self.entries.get(key)
+            path = entry.get("frames", {}).get(volume_key) if entry else None
+        return path if path and os.path.exists(path) else None
+
+    def add_frames(self, key: str, volume_key: str, path: str):
+        """Record a frame file built for a cached song (it counts toward the quota)"""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry.setdefault("frames", {})[volume_key] = path
+            entry["size"] += os.path.getsize(path)
+            self._dirty = True
+
+    def loudness_for(self, key: str) -> Optional[float]:
+        """Get a cached song's measured integrated loudness in LUFS, if it has been analysed"""
+        with self._lock:
+            entry = self.entries.get(key)
+            return entry.get("loudness") if entry else None
+
+    def set_loudness(self, key: str, loudness: float):
+        """Record the measured loudness of a cached song"""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry["loudness"] = loudness
+            self._dirty = True
+
+    def add(self, key: str, filename: str, data: Dict):
+        """Record a finished download"""
+        with self._lock:
+            self.entries[key] = {
+                "file": filename,
+                "size": os.path.getsize(filename),
+                "added": time.time(),
+                "last_used": time.time(),
+                "plays": 0,
+                "info": {field: data.get(field) for field in CACHED_INFO_FIELDS},
+            }
+            self._dirty = True
+
+    def pin(self, key: str):
+        """Protect a song from eviction while it is playing"""
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def unpin(self, key: str):
+        """Release a pin taken with pin()"""
+        with self._lock:
+            if key in self._pinned:
+                self._pinned[key] -= 1
+                if self._pinned[key] <= 0:
+                    del self._pinned[key]
+
+    def total_bytes(self) -> int:
+        """Total size of all cached songs"""
+        with self._lock:
+            return sum(entry["size"] for entry in self.entries.values())
+
+    def evict(self) -> int:
+        """Remove least recently used songs until under quota, plus stray files. Returns files removed."""
+        removed = 0
+
+        with self._lock:
+            total = sum(entry["size"] for entry in self.entries.values())
+            victims = []
+            for key, entry in sorted(self.entries.items(), key=lambda item: item[1]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                if key in self._pinned:
+                    continue
+                victims.append(entry["file"])
+                victims.extend(entry.get("frames", {}).values())
+                total -= entry["size"]
+                del self.entries[key]
+            known_files = set()
+            for entry in self.entries.values():
+                known_files.add(os.path.abspath(entry["file"]))
+                known_files.update(os.path.abspath(path) for path in entry.get("frames", {}).values())
+
+        # Files nobody indexed (old title-named downloads, abandoned .part files), given time to finish
+        cutoff_time = time.time() - MUSIC_CONFIG["cache_orphan_grace"]
+        for file_path in glob.glob(os.path.join(self.directory, "*")):
+            if file_path.endswith(('.json', '.json.tmp')) or os.path.abspath(file_path) in known_files:
+                continue
+            try:
+                if os.path.getmtime(file_path) < cutoff_time:
+                    victims.append(file_path)
+            except OSError:
+                pass
+
+        for file_path in victims:
+            try:
+                os.remove(file_path)
+                removed += 1
+            except Exception as e:
+                log.warning("⚠️ Failed to remove %s: %s", file_path, e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+        with self._lock:
+            self.evictions += removed
+        if removed or self._dirty:
+            self.save_index()
+        if removed:
+            log.info("🗑️ Evicted %d file(s) from the download cache", removed)
+        return removed
+
+    async def _eviction_loop(self, interval: int):
+        """Run eviction in the background for as long as the bot is up"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.evict)
+            except Exception as e:
+                log.error("⚠️ Cache eviction error: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+            await asyncio.sleep(interval)
+
+    def start_eviction(self):
+        """Start the background eviction loop if it isn't running yet"""
+        if self.eviction_task is None or self.eviction_task.done():
+            self.eviction_task = asyncio.get_running_loop().create_task(
+                self._eviction_loop(MUSIC_CONFIG["cache_evict_interval"])
+            )
+
+    def get_stats(self) -> Dict:
+        """Get cache statistics"""
+        lookups = self.hits + self.misses
+        return {
+            "files": len(self.entries),
+            "total_bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+# Bulky info dict fields that aren't needed once a format has been picked
+HEAVY_INFO_FIELDS = (
+    'formats', 'thumbnails', 'subtitles', 'automatic_captions', 'heatmap', 'description', 'tags', 'categories',
+)
+
+def stream_url_expiry(url: str) -> float:
+    """When a signed stream URL stops working (YouTube puts it in the expire= parameter)"""
+    try:
+        expire = parse_qs(urlparse(url).query).get('expire')
+        if expire:
+            return float(expire[0])
+    except ValueError:
+        pass
+    return time.time() + MUSIC_CONFIG["stream_url_ttl"]
+
+class MetadataCache:
+    """Remembers search results and song info so repeat requests can skip extraction.
+    
+    Stable metadata (query -> video, title, duration) and signed stream URLs have separate
+    lifetimes: an expired stream URL only means the song has to be re-extracted by its page URL.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(MUSIC_CONFIG["cache_dir"], "metadata.json")
+        self.queries: Dict[str, Dict] = {}
+        self.videos: Dict[str, Dict] = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.autosave_task = None
+        self._dirty = False
+        self._load()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Normalize a search so trivially different spellings share an entry"""
+        return " ".join(query.lower().split())
+
+    def _load(self):
+        """Load cached metadata from disk"""
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.queries = data.get("queries", {})
+                self.videos = data.get("videos", {})
+                log.info("📇 Loaded metadata for %d songs and %d searches", len(self.videos), len(self.queries))
+        except Exception as e:
+            log.warning("⚠️ Failed to load metadata cache: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+    def save(self):
+        """Write cached metadata to disk atomically, dropping expired and excess entries"""
+        self._write(self._snapshot())
+
+    def _snapshot(self) -> Dict:
+        """Drop expired and excess entries and take what should be written (on the event loop)"""
+        now = time.time()
+        self.queries = {
+            query: entry for query, entry in self.queries.items()
+            if now - entry["cached_at"] < MUSIC_CONFIG["query_ttl"]
+        }
+        self.videos = {
+            key: entry for key, entry in self.videos.items()
+            if now - entry["cached_at"] < MUSIC_CONFIG["metadata_ttl"]
+        }
+        if len(self.videos) > MUSIC_CONFIG["metadata_max_entries"]:
+            newest = sorted(self.videos.items(), key=lambda item: item[1]["cached_at"], reverse=True)
+            self.videos = dict(newest[:MUSIC_CONFIG["metadata_max_entries"]])
+        self._dirty = False
+        return {"queries": dict(self.queries), "videos": dict(self.videos)}
+
+    def _write(self, payload: Dict):
+        """Write a snapshot to disk; safe to run off the event loop"""
+        try:
+            tmp_file = self.path + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(payload, f, ensure_ascii=False, default=str)
+            os.replace(tmp_file, self.path)
+        except Exception as e:
+            self._dirty = True
+            log.warning("⚠️ Failed to save metadata cache: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+    async def _autosave_loop(self, interval: int):
+        """Flush entries stored since the last write, writing the file off the event loop"""
+        while True:
+            await asyncio.sleep(interval)
+            if self._dirty:
+                payload = self._snapshot()
+                await asyncio.get_running_loop().run_in_executor(None, self._write, payload)
+
+    def start_autosave(self):
+        """Start the background save loop if it isn't running yet"""
+        if self.autosave_task is None or self.autosave_task.done():
+            self.autosave_task = asyncio.get_running_loop().create_task(
+                self._autosave_loop(MUSIC_CONFIG["metadata_save_interval"])
+            )
+
+    def lookup_query(self, query: str) -> Optional[str]:
+        """Get the cache key a search resolved to last time"""
+        entry = self.queries.get(self.normalize_query(query))
+        if entry and time.time() - entry["cached_at"] < MUSIC_CONFIG["query_ttl"]:
+            return entry["key"]
+        return None
+
+    def get(self, key: str, *, need_stream: bool = False) -> Optional[Dict]:
+        """Get cached info for a song. With need_stream, only if its stream URL is still good."""
+        entry = self.videos.get(key)
+        if entry is None or time.time() - entry["cached_at"] >= MUSIC_CONFIG["metadata_ttl"]:
+            self.misses += 1
+            return None
+        if need_stream and not self.stream_valid(entry["stream_expires"]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["info"]
+
+    @staticmethod
+    def stream_valid(expires: Optional[float]) -> bool:
+        """Check that a stream URL will stay valid long enough to play from"""
+        return expires is not None and time.time() < expires - MUSIC_CONFIG["stream_url_margin"]
+
+    def store(self, key: str, data: Dict, query: str = None):
+        """Remember an extraction result (and the search that led to it)"""
+        now = time.time()
+        self.videos[key] = {
+            "info": {
+                field: value for field, value in data.items()
+                if field not in HEAVY_INFO_FIELDS and not field.startswith('_')
+            },
+            "cached_at": now,
+            "stream_expires": stream_url_expiry(data['url']) if data.get('url') else None,
+        }
+        if query:
+            self.queries[self.normalize_query(query)] = {"key": key, "cached_at": now}
+
+        # Written by the autosave loop, never from here: store runs on the event loop
+        self._dirty = True
+
+    def get_stats(self) -> Dict:
+        """Get cache statistics"""
+        lookups = self.hits + self.misses
+        return {
+            "songs": len(self.videos),
+            "searches": len(self.queries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "refreshes": self.refreshes,
+        }
@@ -0,0 +1,99 @@
+# opus_frames.py - Pre-encoded Opus frame store for MikuChan Bot
+
+import mmap
+import os
+import struct
+import subprocess
+from typing import Callable, List
+import discord
+from discord.oggparse import OggStream
+
+# File layout: header, (frame count + 1) little-endian u32 offsets into the packet data, packet data.
+# Every packet is one 20 ms Opus frame, ready to send to Discord as-is.
+MAGIC = b"MKOPUS01"
+HEADER = struct.Struct('<8sI')
+OFFSET = struct.Struct('<I')
+
+FRAME_SECONDS = 0.02
+
+def write_frame_file(path: str, packets: List[bytes]):
+    """Write Opus packets to a framed file, atomically"""
+    offsets = [0]
+    for packet in packets:
+        offsets.append(offsets[-1] + len(packet))
+
+    tmp_file = path + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(packets)))
+        f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        for packet in packets:
+            f.write(packet)
+    os.replace(tmp_file, path)
+
+def encode_frames(source: str, path: str, *, volume: float = 1.0, bitrate: int = 128, executable: str = 'ffmpeg',
+                  spawn: Callable = subprocess.Popen) -> int:
+    """Encode an audio file into a frame file with FFmpeg, with volume baked in. Returns the frame count.
+
+    spawn starts the FFmpeg process (e.g. through a supervisor); it takes Popen's arguments.
+    """
+    args = [
+        executable, '-nostdin', '-loglevel', 'error', '-i', source, '-vn',
+        '-af', f'volume={volume:.2f}', '-c:a', 'libopus', '-b:a', f'{bitrate}k',
+        '-frame_duration', '20', '-ar', '48000', '-ac', '2', '-f', 'ogg', 'pipe:1',
+    ]
+    process = spawn(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    try:
+        packets = [
+            packet for packet in OggStream(process.stdout).iter_packets()
+            if not packet.startswith((b'OpusHead', b'OpusTags'))
+        ]
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+
+    if returncode != 0:
+        raise RuntimeError(f"FFmpeg exited with code {returncode} while encoding {source}")
+
+    write_frame_file(path, packets)
+    return len(packets)
+
+class OpusFrameSource(discord.AudioSource):
+    """Plays a frame file straight from a memory map, with no FFmpeg process at all"""
+
+    def __init__(self, path: str, *, start_frame: int = 0):
+        self._file = None
+        self._map = None
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.frame_count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            # Not cleanup(): subclasses extend it and aren't set up yet
+            self._close()
+            raise ValueError(f"Not an Opus frame file: {path}")
+
+        self._offsets_start = HEADER.size
+        self._data_start = HEADER.size + OFFSET.size * (self.frame_count + 1)
+        self._frame = min(max(start_frame, 0), self.frame_count)
+
+    def read(self) -> bytes:
+        if self._map is None or self._frame >= self.frame_count:
+            return b''
+        offset_pos = self._offsets_start + OFFSET.size * self._frame
+        start, end = struct.unpack_from('<II', self._map, offset_pos)
+        self._frame += 1
+        return self._map[self._data_start + start:self._data_start + end]
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self._close()
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
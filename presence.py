@@ -0,0 +1,91 @@
+# presence.py - Coalesced presence updates for MikuChan Bot
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+import discord
+from config import MUSIC_CONFIG, DEBUG_CONFIG
+
+log = logging.getLogger("miku.presence")
+
+class PresenceManager:
+    """Keeps the bot's status in sync with what's playing, without flooding the gateway.
+
+    Commands only record what changed; a background task waits for changes to settle and
+    sends at most one presence update per interval, so no reply ever waits on change_presence.
+    """
+
+    def __init__(self, bot, idle_name: str = "🎵 Music & AI Chat | !help"):
+        self.bot = bot
+        self.idle_name = idle_name
+        self.playing: Dict[int, Tuple[str, float]] = {}
+        self.updates_requested = 0
+        self.updates_sent = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed: Optional[asyncio.Event] = None
+        self._last_sent = None
+
+    def set_idle_name(self, name: str):
+        """Set the status shown when nothing is playing"""
+        self.idle_name = name
+        self._request()
+
+    def track_started(self, guild_id: int, title: str):
+        """Record that a server started a song"""
+        self.playing[guild_id] = (title, time.monotonic())
+        self._request()
+
+    def track_stopped(self, guild_id: int):
+        """Record that a server stopped playing"""
+        if self.playing.pop(guild_id, None) is not None:
+            self._request()
+
+    def _request(self):
+        self.updates_requested += 1
+        if self._changed is not None:
+            self._changed.set()
+
+    def _desired(self) -> Tuple[str, str]:
+        """Work out the status to show as (kind, text)"""
+        if not self.playing:
+            return "game", self.idle_name
+        if len(self.playing) == 1 or MUSIC_CONFIG["presence_mode"] == "latest":
+            title, _ = max(self.playing.values(), key=lambda item: item[1])
+            return "listening", title[:128]
+        return "listening", f"music in {len(self.playing)} servers"
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            # Let a burst of changes settle into one update
+            await asyncio.sleep(MUSIC_CONFIG["presence_debounce"])
+            self._changed.clear()
+
+            desired = self._desired()
+            if desired == self._last_sent:
+                continue
+
+            kind, text = desired
+            if kind == "game":
+                activity = discord.Game(name=text)
+            else:
+                activity = discord.Activity(type=discord.ActivityType.listening, name=text)
+
+            try:
+                await self.bot.change_presence(activity=activity)
+                self._last_sent = desired
+                self.updates_sent += 1
+            except Exception as e:
+                log.warning("⚠️ Presence update failed: %s", e, exc_info=DEBUG_CONFIG["verbose_errors"])
+
+            await asyncio.sleep(MUSIC_CONFIG["presence_min_interval"])
+
+    def start(self):
+        """Start the background sender if it isn't running yet, and (re)send the current status"""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        self._last_sent = None
+        self._request()